@@ -0,0 +1,58 @@
+import sys
+import json
+
+# Rough request-unit prices so runs can be compared; real charges depend on indexing and document shape.
+POINT_READ_RU = 1.0
+QUERY_BASE_RU = 2.5
+WRITE_RU = 5.5
+
+WORDS = ("great", "shot", "love", "this", "colour", "light", "wow", "nice", "where", "was", "taken", "again")
+
+
+def comment_text(rng):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 8)))
+
+def add_report_arguments(parser):
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help="Print results as JSON.")
+    parser.add_argument('--baseline', help="Output of an earlier --json run to compare against.")
+    parser.add_argument('--tolerance', type=float, default=0.25)
+
+def compare_with_baseline(results, baseline, key, gated, tolerance):
+    # Timings vary between machines, so only metrics accepted by gated are compared.
+    regressions = []
+    expected_by_key = {str(expected[key]): expected for expected in baseline}
+
+    for result in results:
+        expected = expected_by_key.get(str(result[key]))
+        if not expected: continue
+
+        for metric, value in result.items():
+            if not gated(metric) or metric not in expected: continue
+            if value > expected[metric] * (1 + tolerance):
+                regressions.append(f"{result[key]}.{metric}: {value} > {expected[metric]} (+{tolerance:.0%})")
+
+    return regressions
+
+def print_results(results, columns):
+    width = max(len(column) for column in columns) + 1
+    print("  ".join(f"{column:>{width}}" for column in columns))
+    for result in results:
+        print("  ".join(f"{result[column]:>{width}}" for column in columns))
+
+def report(results, args, key, columns, gated):
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results, columns)
+
+    if not args.baseline:
+        return 0
+
+    with open(args.baseline) as f:
+        regressions = compare_with_baseline(results, json.load(f), key, gated, args.tolerance)
+
+    for regression in regressions:
+        print(f"Regression: {regression}", file=sys.stderr)
+
+    return 1 if regressions else 0
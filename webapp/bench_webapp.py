@@ -0,0 +1,215 @@
+import sys
+import json
+import time
+import logging
+import base64
+import random
+import argparse
+import threading
+from unittest.mock import patch
+from urllib.parse import urlparse, parse_qs
+from webapp.webapp import load_album_page, fetch_media_changes, merge_media_changes, latest_timestamp
+from webapp.webapp import get_album_cache, get_comment_view, take_missing_translations, create_secure_temporary_links, is_visible
+
+from bench_common import POINT_READ_RU, QUERY_BASE_RU, comment_text, add_report_arguments, report
+
+READ_URL = "https://read.example.net/api/read"
+USER_ID = "user0"
+REPORT_COLUMNS = ('documents', 'first_page_cold_ms', 'first_page_cold_reads', 'first_page_warm_ms', 'full_album_reads', 'full_album_ru',
+                  'render_cold_ms', 'render_warm_ms', 'delta_sync_ms', 'delta_sync_ru')
+
+
+class FakeResponse:
+    def __init__(self, status_code, payload):
+        self.status_code = status_code
+        self.payload = payload
+
+    def json(self):
+        return self.payload
+
+
+class FakeReadFunction:
+    """Stand-in for the READ function: paging, visibility filters and delta sync over in-memory documents."""
+
+    def __init__(self, documents, latency=0.0, error_rate=0.0, seed=0):
+        self.documents = documents
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.reads = 0
+        self.request_units = 0.0
+        self.lock = threading.Lock()
+
+    def matches(self, doc, user_id, visibility):
+        if visibility == 'public':
+            return not doc.get('isPrivate')
+        if visibility == 'private':
+            return doc.get('isPrivate') and doc.get('userID') == user_id
+
+        return not doc.get('isPrivate') or doc.get('userID') == user_id
+
+    def get(self, url, **kwargs):
+        params = {key: values[0] for key, values in parse_qs(urlparse(url).query).items()}
+
+        with self.lock:
+            self.reads += 1
+            failed = self.random.random() < self.error_rate
+
+        if self.latency:
+            time.sleep(self.latency)
+        if failed:
+            return FakeResponse(500, {"error": "Injected READ failure"})
+
+        items = [doc for doc in self.documents if self.matches(doc, params.get('userID'), params.get('visibility'))]
+        if 'since' in params:
+            items = [doc for doc in items if doc['_ts'] > int(params['since'])]
+
+        continuation = None
+        if 'pageSize' in params:
+            start = int(params.get('continuation', 0))
+            end = start + int(params['pageSize'])
+            continuation = str(end) if end < len(items) else None
+            items = items[start:end]
+
+        payload = {"items": items, "continuation": continuation, "deleted": []}
+        with self.lock:
+            self.request_units += QUERY_BASE_RU + POINT_READ_RU * len(json.dumps(items)) / 1024
+
+        return FakeResponse(200, json.loads(json.dumps(payload)))
+
+
+def build_documents(rng, count, comments_per_document, language):
+    documents = []
+    for index in range(count):
+        comments = []
+        for position in range(comments_per_document):
+            text = comment_text(rng)
+            comment = {'id': f"c{index}-{position}", 'user': f"user{rng.randrange(50)}", 'text': text, 'timestamp': f"{index}-{position}"}
+            if rng.random() < 0.7:
+                comment['translations'] = {language: f"[{language}] {text}"}
+            comments.append(comment)
+
+        documents.append({
+            'id': f"doc{index}",
+            'fileName': f"photo{index}.png",
+            'uniqueFileName': f"blob{index}.png",
+            'thumbnailFileName': f"thumbnails/blob{index}.png.webp",
+            'userID': f"user{index % 50}",
+            'isPrivate': rng.random() < 0.1,
+            'likes': rng.randrange(100),
+            'comments': comments,
+            '_ts': 1700000000 + count - index
+        })
+
+    return documents
+
+def measure(read_function, action):
+    reads = read_function.reads
+    request_units = read_function.request_units
+    started = time.perf_counter()
+
+    result = action()
+
+    return result, {
+        'ms': round((time.perf_counter() - started) * 1000, 2),
+        'reads': read_function.reads - reads,
+        'ru': round(read_function.request_units - request_units, 1)
+    }
+
+def load_full_album():
+    status, items, continuation = load_album_page(READ_URL, USER_ID)
+    while status == 200 and continuation:
+        status, page, continuation = load_album_page(READ_URL, USER_ID, continuation)
+        known_ids = {item.get('id') for item in items}
+        items.extend(item for item in page if item.get('id') not in known_ids)
+
+    return items
+
+def prepare_album(items, comment_index, language):
+    # Everything render_album_section computes before handing tiles to Streamlit.
+    visible_files = [file for file in items if is_visible(file, USER_ID)]
+    comment_views = [get_comment_view(comment_index, file, language) for file in visible_files]
+    missing = take_missing_translations(comment_views)
+    links = create_secure_temporary_links(
+        [file.get('uniqueFileName', '') for file in visible_files]
+        + [file.get('thumbnailFileName', '') for file in visible_files]
+    )
+
+    return visible_files, missing, links
+
+def run_size(count, args):
+    rng = random.Random(args.seed)
+    documents = build_documents(rng, count, args.comments, args.language)
+    read_function = FakeReadFunction(documents, args.latency_ms / 1000, args.read_errors, args.seed)
+    result = {'documents': count}
+
+    with patch('webapp.webapp.requests.get', side_effect=read_function.get):
+        run_steps(rng, documents, read_function, result, args)
+
+    return result
+
+def run_steps(rng, documents, read_function, result, args):
+    count = len(documents)
+
+    def record(step, measurement):
+        for key, value in measurement.items():
+            result[f"{step}_{key}"] = value
+
+    get_album_cache.clear()
+    _, measurement = measure(read_function, lambda: load_album_page(READ_URL, USER_ID))
+    record('first_page_cold', measurement)
+
+    _, measurement = measure(read_function, lambda: load_album_page(READ_URL, USER_ID))
+    record('first_page_warm', measurement)
+
+    get_album_cache.clear()
+    items, measurement = measure(read_function, load_full_album)
+    record('full_album', measurement)
+
+    comment_index = {}
+    (visible_files, missing, links), measurement = measure(read_function, lambda: prepare_album(items, comment_index, args.language))
+    record('render_cold', measurement)
+    result['missing_translations'] = len(missing)
+
+    _, measurement = measure(read_function, lambda: prepare_album(items, comment_index, args.language))
+    record('render_warm', measurement)
+
+    # One percent of the album changes between refreshes.
+    since = latest_timestamp(items)
+    for offset, doc in enumerate(rng.sample(documents, max(1, count // 100))):
+        doc['likes'] += 1
+        doc['_ts'] = since + 1 + offset
+
+    def delta_sync():
+        status, data = fetch_media_changes(READ_URL, USER_ID, since)
+        return merge_media_changes(list(items), data.get('items', []), data.get('deleted', []))
+
+    _, measurement = measure(read_function, delta_sync)
+    record('delta_sync', measurement)
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Measure album load and render cost against an in-process READ function.")
+    parser.add_argument('--sizes', default="100,1000,10000", help="Comma separated album sizes.")
+    parser.add_argument('--comments', type=int, default=3, help="Comments per document.")
+    parser.add_argument('--language', default="fr")
+    parser.add_argument('--latency-ms', type=float, default=20)
+    parser.add_argument('--read-errors', type=float, default=0.0)
+    add_report_arguments(parser)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.getLogger('streamlit').setLevel(logging.ERROR)
+    signer = {"account_name": "bench", "account_key": base64.b64encode(b"bench" * 8).decode(), "links": {}, "lock": threading.Lock()}
+
+    results = []
+    for count in [int(size) for size in args.sizes.split(',') if size.strip()]:
+        signer['links'] = {}
+
+        with patch('webapp.webapp.get_link_signer', return_value=signer):
+            results.append(run_size(count, args))
+
+    return report(results, args, 'documents', REPORT_COLUMNS, lambda metric: metric.endswith(('_reads', '_ru')))
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,16 @@
 import unittest
-from webapp.webapp import format_url, get_connection_settings
+import threading
+import json
+from unittest.mock import patch, MagicMock
+from webapp.webapp import format_url, get_connection_settings, send_translation_request
+from webapp.webapp import update_media_metadata, update_media_likes, update_media_comments, build_read_url, parse_media_page, is_visible
+from webapp.webapp import create_secure_temporary_links, upload_media_direct
+from webapp.webapp import merge_media_changes, latest_timestamp, fetch_media_changes
+from webapp.webapp import get_album_cache, cached_fetch, invalidate_album_cache, load_album_page
+from webapp.webapp import build_comment_view, get_comment_view, take_missing_translations, parse_languages
+from webapp.webapp import send_bulk_translation_request, run_like_write, reconcile_writes, get_write_queue
+from webapp.webapp import schedule_like_write, apply_optimistic_change, writes_pending
+import streamlit as st
 
 class TestWebappLogic(unittest.TestCase):
 
@@ -27,5 +38,370 @@ class TestWebappLogic(unittest.TestCase):
         self.assertEqual(account_name, "testaccountname")
         self.assertEqual(account_key, "testaccountkey==")
 
+    @patch('webapp.webapp.requests.put')
+    def test_send_translation_request_includes_partition_key(self, mock_put):
+        update_url = "https://example.com/api/items/%7Bid%7D"
+
+        result = send_translation_request(update_url, "doc1", "ts", "fr", comment_id="c1", partition_key="user1")
+
+        self.assertTrue(result)
+        args, kwargs = mock_put.call_args
+        self.assertEqual(args[0], "https://example.com/api/items/translation_request")
+        self.assertEqual(kwargs['json']['partitionKey'], "user1")
+        self.assertEqual(kwargs['json']['commentID'], "c1")
+
+    @patch('webapp.webapp.UPDATE_PATCH', True)
+    @patch('webapp.webapp.requests.patch')
+    def test_update_media_likes_sends_increment(self, mock_patch):
+        mock_patch.return_value.status_code = 200
+        update_url = "https://example.com/api/items/%7Bid%7D"
+        media_file = {"id": "doc1", "likes": 4, "comments": [{"id": "c1"}]}
+
+        self.assertEqual(update_media_likes(update_url, "doc1", media_file), 200)
+
+        args, kwargs = mock_patch.call_args
+        self.assertEqual(args[0], "https://example.com/api/items/doc1")
+        self.assertEqual(kwargs['json'], {
+            "partitionKey": "doc1",
+            "operations": [{"op": "incr", "path": "/likes", "value": 1}]
+        })
+
+    @patch('webapp.webapp.UPDATE_PATCH', True)
+    @patch('webapp.webapp.requests.patch')
+    def test_update_media_comments_appends_only_new_comment(self, mock_patch):
+        mock_patch.return_value.status_code = 200
+        update_url = "https://example.com/api/items/%7Bid%7D"
+        media_file = {"id": "doc1", "comments": [{"id": "c1"}]}
+        new_comment = {"id": "c2", "text": "Hi"}
+
+        update_media_comments(update_url, "doc1", media_file, new_comment)
+
+        operations = mock_patch.call_args[1]['json']['operations']
+        self.assertEqual(operations, [{"op": "add", "path": "/comments/-", "value": new_comment}])
+
+    @patch('webapp.webapp.requests.put')
+    @patch('webapp.webapp.requests.patch')
+    def test_update_media_comments_puts_document_by_default(self, mock_patch, mock_put):
+        mock_put.return_value.status_code = 200
+        update_url = "https://example.com/api/items/%7Bid%7D"
+        media_file = {"id": "doc1", "comments": [{"id": "c1"}], "_rid": "r"}
+
+        self.assertEqual(update_media_comments(update_url, "doc1", media_file, {"id": "c2"}), 200)
+
+        mock_patch.assert_not_called()
+        self.assertEqual(mock_put.call_args[1]['json'], {"id": "doc1", "comments": [{"id": "c1"}, {"id": "c2"}]})
+        self.assertEqual(mock_put.call_args[1]['headers'], {})
+        self.assertEqual(media_file['comments'], [{"id": "c1"}])
+
+    @patch('webapp.webapp.UPDATE_PATCH', True)
+    @patch('webapp.webapp.requests.patch')
+    def test_update_media_metadata_sets_only_edited_fields(self, mock_patch):
+        mock_patch.return_value.status_code = 200
+        update_url = "https://example.com/api/items/%7Bid%7D"
+        media_file = {"id": "doc1", "fileName": "old.png", "isPrivate": False, "comments": [{"id": "c1"}], "likes": 3}
+
+        self.assertEqual(update_media_metadata(update_url, "doc1", media_file, "new.png", True), 200)
+        self.assertEqual(mock_patch.call_args[1]['json']['operations'], [
+            {"op": "set", "path": "/fileName", "value": "new.png"},
+            {"op": "set", "path": "/isPrivate", "value": True}
+        ])
+
+    @patch('webapp.webapp.requests.put')
+    def test_update_media_metadata_put_is_conditional(self, mock_put):
+        mock_put.return_value.status_code = 412
+        update_url = "https://example.com/api/items/%7Bid%7D"
+        media_file = {"id": "doc1", "fileName": "old.png", "isPrivate": False, "_etag": '"0000-1"'}
+
+        self.assertEqual(update_media_metadata(update_url, "doc1", media_file, "new.png", True), 412)
+
+        kwargs = mock_put.call_args[1]
+        self.assertEqual(kwargs['headers'], {"If-Match": '"0000-1"'})
+        self.assertEqual(kwargs['json'], {"id": "doc1", "fileName": "new.png", "isPrivate": True})
+
+    @patch('webapp.webapp.UPDATE_PATCH', True)
+    @patch('webapp.webapp.requests.put')
+    @patch('webapp.webapp.requests.patch')
+    def test_update_media_likes_falls_back_to_put(self, mock_patch, mock_put):
+        mock_patch.return_value.status_code = 405
+        mock_put.return_value.status_code = 200
+        update_url = "https://example.com/api/items/%7Bid%7D"
+
+        self.assertEqual(update_media_likes(update_url, "doc1", {"id": "doc1", "likes": 4}, increment=2), 200)
+        self.assertEqual(mock_put.call_args[1]['json'], {"id": "doc1", "likes": 6})
+
+    def test_build_read_url_pagination(self):
+        url = build_read_url("https://example.com/api/read?code=abc", {
+            "userID": "user 1",
+            "pageSize": 24,
+            "continuation": None
+        })
+
+        self.assertEqual(url, "https://example.com/api/read?code=abc&userID=user%201&pageSize=24")
+
+    def test_parse_media_page(self):
+        self.assertEqual(parse_media_page([{"id": "1"}]), ([{"id": "1"}], None))
+        self.assertEqual(
+            parse_media_page({"items": [{"id": "2"}], "continuation": "token"}),
+            ([{"id": "2"}], "token")
+        )
+
+    def test_is_visible(self):
+        self.assertTrue(is_visible({"isPrivate": False, "userID": "other"}, "me"))
+        self.assertTrue(is_visible({"isPrivate": True, "userID": "me"}, "me"))
+        self.assertFalse(is_visible({"isPrivate": True, "userID": "other"}, "me"))
+
+    @patch('webapp.webapp.generate_blob_sas')
+    @patch('webapp.webapp.get_link_signer')
+    def test_create_secure_temporary_links_reuses_fresh_tokens(self, mock_signer, mock_generate):
+        mock_signer.return_value = {
+            "account_name": "testaccountname",
+            "account_key": "testaccountkey==",
+            "links": {},
+            "lock": threading.Lock()
+        }
+        mock_generate.return_value = "sig=abc"
+
+        links = create_secure_temporary_links(["a.png", "b.mp4", ""])
+        again = create_secure_temporary_links(["a.png"])
+
+        self.assertEqual(links["a.png"], "https://testaccountname.blob.core.windows.net/mediastorage/a.png?sig=abc")
+        self.assertNotIn("", links)
+        self.assertEqual(again["a.png"], links["a.png"])
+        self.assertEqual(mock_generate.call_count, 2)
+
+    @patch('webapp.webapp.get_upload_queue')
+    @patch('webapp.webapp.BlobClient')
+    @patch('webapp.webapp.get_link_signer')
+    def test_upload_media_direct_streams_blob_and_enqueues(self, mock_signer, mock_blob_client, mock_queue):
+        mock_signer.return_value = {
+            "account_name": "testaccountname",
+            "account_key": "dGVzdGFjY291bnRrZXk=",
+            "links": {},
+            "lock": threading.Lock()
+        }
+        file_object = MagicMock()
+        file_object.name = "clip.mp4"
+        file_object.size = 10
+        file_object.type = "video/mp4"
+
+        status = upload_media_direct(file_object, "My clip", "a@b.com", "user1", True)
+
+        self.assertEqual(status, 202)
+        upload_kwargs = mock_blob_client.from_blob_url.return_value.upload_blob.call_args[1]
+        self.assertEqual(upload_kwargs['length'], 10)
+
+        message = json.loads(mock_queue.return_value.send_message.call_args[0][0])
+        self.assertTrue(message['blobName'].endswith(".mp4"))
+        self.assertTrue(message['blobName'].startswith(message['id']))
+        self.assertEqual(message['isPrivate'], "true")
+
+    def test_merge_media_changes_in_place(self):
+        album_data = [{"id": "1", "likes": 0}, {"id": "2"}, {"id": "3"}]
+        original = album_data
+
+        changed = merge_media_changes(album_data, [{"id": "1", "likes": 5}, {"id": "4"}], ["2"])
+
+        self.assertIs(album_data, original)
+        self.assertEqual(changed, 3)
+        self.assertEqual(album_data, [{"id": "4"}, {"id": "1", "likes": 5}, {"id": "3"}])
+
+    def test_merge_media_changes_ignores_unchanged_items(self):
+        album_data = [{"id": "1", "_ts": 10}, {"id": "2", "_ts": 9}]
+
+        self.assertEqual(merge_media_changes(album_data, [{"id": "1", "_ts": 10}], ["5"]), 0)
+        self.assertEqual(album_data, [{"id": "1", "_ts": 10}, {"id": "2", "_ts": 9}])
+
+    @patch('webapp.webapp.requests.get')
+    def test_fetch_media_changes_overlaps_last_second(self, mock_get):
+        mock_get.return_value.status_code = 200
+        mock_get.return_value.json.return_value = {"items": [], "deleted": []}
+
+        fetch_media_changes("https://example.com/api/read?code=abc", "user1", 1700000010)
+
+        self.assertIn("since=1700000009", mock_get.call_args[0][0])
+
+    def test_latest_timestamp(self):
+        self.assertEqual(latest_timestamp([{"_ts": 5}, {"_ts": 9}, {}]), 9)
+        self.assertEqual(latest_timestamp([], since=7), 7)
+        self.assertIsNone(latest_timestamp([{"id": "1"}]))
+
+    def test_album_cache_shares_public_pages_and_invalidates(self):
+        get_album_cache.clear()
+        pages = {
+            "public": {"items": [{"id": "p1", "_ts": 5}], "continuation": "next"},
+            "private": {"items": [{"id": "mine", "_ts": 9}]}
+        }
+        fetch_calls = []
+
+        def fake_display_media(read_url, user_id, page_size=None, continuation=None, visibility="visible"):
+            fetch_calls.append((user_id, visibility))
+            return 200, pages[visibility]
+
+        with patch('webapp.webapp.display_media', side_effect=fake_display_media):
+            status, items, continuation = load_album_page("https://example.com/read", "user1")
+            load_album_page("https://example.com/read", "user2")
+
+            self.assertEqual(status, 200)
+            self.assertEqual([item["id"] for item in items], ["mine", "p1"])
+            self.assertEqual(continuation, "next")
+            self.assertEqual(fetch_calls.count((None, "public")), 1)
+
+            invalidate_album_cache("user1")
+            load_album_page("https://example.com/read", "user1")
+            load_album_page("https://example.com/read", "user2")
+
+        self.assertEqual(fetch_calls.count((None, "public")), 2)
+        self.assertEqual(fetch_calls.count(("user1", "private")), 2)
+        self.assertEqual(fetch_calls.count(("user2", "private")), 1)
+
+    @patch('webapp.webapp.ALBUM_CACHE_MAX_BYTES', 40)
+    def test_album_cache_evicts_by_size(self):
+        get_album_cache.clear()
+
+        cached_fetch(('public', 1, None), lambda: (200, {"items": [{"id": "a" * 10}]}))
+        cached_fetch(('public', 1, "next"), lambda: (200, {"items": [{"id": "b" * 10}]}))
+
+        cache = get_album_cache()
+        self.assertEqual(list(cache['entries']), [('public', 1, "next")])
+        self.assertLessEqual(cache['size'], 40)
+
+    def test_build_comment_view(self):
+        media_file = {"id": "doc1", "comments": [
+            {"id": "c1", "user": "a", "text": "Hi", "timestamp": "t1", "translations": {"fr": "Salut"}},
+            {"id": "c2", "user": "b", "text": "Bye", "timestamp": "t2", "translations": {}}
+        ]}
+
+        view = build_comment_view(media_file, "fr")
+
+        self.assertEqual(view["display"], [("a", "Salut", "Hi"), ("b", "Bye", "Bye")])
+        self.assertEqual([item["id"] for item in view["missing"]], ["c2"])
+        self.assertEqual(build_comment_view(media_file, "Original")["missing"], [])
+
+    def test_get_comment_view_rebuilds_only_replaced_items(self):
+        comment_index = {}
+        media_file = {"id": "doc1", "comments": [{"id": "c1", "text": "Hi", "timestamp": "t1"}]}
+
+        first = get_comment_view(comment_index, media_file, "fr")
+        self.assertIs(get_comment_view(comment_index, media_file, "fr"), first)
+
+        updated = dict(media_file, comments=[{"id": "c1", "text": "Hi", "timestamp": "t1", "translations": {"fr": "Salut"}}])
+        second = get_comment_view(comment_index, updated, "fr")
+
+        self.assertIsNot(second, first)
+        self.assertEqual(second["missing"], [])
+
+    def test_take_missing_translations_offers_each_comment_once(self):
+        comment_index = {}
+        media_file = {"id": "doc1", "comments": [{"id": "c1", "text": "Hi", "timestamp": "t1"}]}
+        views = [get_comment_view(comment_index, media_file, "fr")]
+
+        self.assertEqual([item["id"] for item in take_missing_translations(views)], ["c1"])
+        self.assertEqual(take_missing_translations([get_comment_view(comment_index, media_file, "fr")]), [])
+
+        # A replaced item is rebuilt and offers its still-missing comments again.
+        liked = dict(media_file, likes=1)
+        self.assertEqual([item["id"] for item in take_missing_translations([get_comment_view(comment_index, liked, "fr")])], ["c1"])
+
+    def test_parse_languages(self):
+        languages = parse_languages("English:en, German:de")
+
+        self.assertEqual(languages, {"Original": "Original", "English": "en", "German": "de"})
+
+    @patch('webapp.webapp.requests.put')
+    def test_send_translation_request_multiple_languages(self, mock_put):
+        update_url = "https://example.com/api/items/%7Bid%7D"
+
+        send_translation_request(update_url, "doc1", "ts", ["en", "fr", "ja"], comment_id="c1")
+
+        payload = mock_put.call_args[1]['json']
+        self.assertEqual(payload['targetLangs'], ["en", "fr", "ja"])
+        self.assertNotIn('targetLang', payload)
+
+    @patch('webapp.webapp.requests.put')
+    def test_send_bulk_translation_request(self, mock_put):
+        update_url = "https://example.com/api/items/%7Bid%7D"
+        items = [
+            {"doc_id": "doc1", "pk": "doc1", "id": "c1", "ts": "t1"},
+            {"doc_id": "doc2", "pk": "doc2", "id": "c2", "ts": "t2"}
+        ]
+
+        self.assertTrue(send_bulk_translation_request(update_url, "ja", items))
+
+        args, kwargs = mock_put.call_args
+        self.assertEqual(args[0], "https://example.com/api/items/translation_request")
+        self.assertEqual(kwargs['json']['task'], "translate_comments")
+        self.assertEqual(kwargs['json']['targetLang'], "ja")
+        self.assertEqual(kwargs['json']['items'][1], {
+            "docID": "doc2", "partitionKey": "doc2", "commentID": "c2", "commentTimestamp": "t2"
+        })
+
+    @patch('webapp.webapp.LIKE_COALESCE_SECONDS', 0.05)
+    @patch('webapp.webapp.get_background_pool')
+    def test_schedule_like_write_submits_after_delay(self, mock_pool):
+        submitted = threading.Event()
+        mock_pool.return_value.submit.side_effect = lambda *args: submitted.set()
+        write_queue = {"pending_likes": {"doc1": 1}, "results": [], "in_flight": 1, "lock": threading.Lock()}
+
+        schedule_like_write(write_queue, "https://example.com/api/items/%7Bid%7D", "doc1", {"id": "doc1"})
+
+        mock_pool.return_value.submit.assert_not_called()
+        self.assertTrue(submitted.wait(2))
+        self.assertIs(mock_pool.return_value.submit.call_args[0][0], run_like_write)
+
+    @patch('webapp.webapp.update_media_likes')
+    def test_run_like_write_coalesces_clicks(self, mock_update_likes):
+        mock_update_likes.return_value = 200
+        write_queue = {"pending_likes": {"doc1": 3}, "results": [], "in_flight": 1, "lock": threading.Lock()}
+        media_file = {"id": "doc1", "userID": "owner"}
+
+        run_like_write(write_queue, "https://example.com/api/items/%7Bid%7D", "doc1", media_file)
+        run_like_write(write_queue, "https://example.com/api/items/%7Bid%7D", "doc1", media_file)
+
+        mock_update_likes.assert_called_once_with("https://example.com/api/items/%7Bid%7D", "doc1", media_file, 3)
+        self.assertEqual(write_queue['results'][0]['increment'], 3)
+
+    @patch('webapp.webapp.st.toast')
+    def test_reconcile_writes_rolls_back_failures(self, mock_toast):
+        st.session_state.clear()
+        st.session_state.album_data = [
+            {"id": "doc1", "likes": 3, "comments": []},
+            {"id": "doc2", "likes": 0, "comments": [{"id": "c1"}]}
+        ]
+        write_queue = get_write_queue()
+        apply_optimistic_change(write_queue, "doc1", lambda item: {"likes": item["likes"] + 2})
+        apply_optimistic_change(write_queue, "doc2", lambda item: {"comments": item["comments"] + [{"id": "c2"}]})
+        write_queue['results'] = [
+            {"kind": "likes", "doc_id": "doc1", "owner_id": "u", "increment": 2, "generation": 0, "status": 500},
+            {"kind": "comment", "doc_id": "doc2", "owner_id": "u", "comment_id": "c2", "generation": 0, "status": "timeout"}
+        ]
+        write_queue['in_flight'] = 0
+
+        self.assertEqual(len(reconcile_writes()), 2)
+
+        self.assertEqual(st.session_state.album_data[0]['likes'], 3)
+        self.assertEqual(st.session_state.album_data[1]['comments'], [{"id": "c1"}])
+        self.assertEqual(mock_toast.call_count, 2)
+        self.assertFalse(writes_pending(write_queue))
+
+    @patch('webapp.webapp.st.toast')
+    def test_reconcile_writes_keeps_items_replaced_by_refresh(self, mock_toast):
+        st.session_state.clear()
+        st.session_state.album_data = [{"id": "doc1", "likes": 3}]
+        write_queue = get_write_queue()
+        generation = apply_optimistic_change(write_queue, "doc1", lambda item: {"likes": item["likes"] + 1})
+
+        # A sync brings the server value, which never included the failed like.
+        st.session_state.album_data[0] = {"id": "doc1", "likes": 3}
+        write_queue['results'] = [{"kind": "likes", "doc_id": "doc1", "owner_id": "u", "increment": 1, "generation": generation, "status": 500}]
+        reconcile_writes()
+        self.assertEqual(st.session_state.album_data[0]['likes'], 3)
+
+        # A like made after the sync starts a new generation, so the old failure cannot undo it.
+        self.assertEqual(apply_optimistic_change(write_queue, "doc1", lambda item: {"likes": item["likes"] + 1}), generation + 1)
+        write_queue['results'] = [{"kind": "likes", "doc_id": "doc1", "owner_id": "u", "increment": 1, "generation": generation, "status": 500}]
+        reconcile_writes()
+        self.assertEqual(st.session_state.album_data[0]['likes'], 4)
+        self.assertEqual(mock_toast.call_count, 2)
+
 if __name__ == '__main__':
     unittest.main()
@@ -2,22 +2,60 @@ import streamlit as st
 import requests
 import os
 from dotenv import load_dotenv
-from azure.storage.blob import generate_blob_sas, BlobSasPermissions
+from azure.storage.blob import generate_blob_sas, generate_container_sas, BlobSasPermissions, ContainerSasPermissions
+from azure.storage.blob import BlobClient, ContentSettings
+from azure.storage.queue import QueueClient, TextBase64EncodePolicy
 from datetime import datetime, timedelta, timezone
-from urllib.parse import quote
+from urllib.parse import quote, urlencode
 import uuid
+import threading
+import json
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 load_dotenv()
 
 CREATE = os.getenv('CREATE', '')  # POST
 READ  = os.getenv('READ', '')   # GET
-UPDATE = os.getenv('UPDATE', '')   # PUT
+UPDATE = os.getenv('UPDATE', '')   # PUT, or PATCH once UPDATE_PATCH is on
 DELETE = os.getenv('DELETE', '')   # DELETE
 CONNECTION = os.getenv('AZURE_CONNECTION_STRING')
 CONTAINER = "mediastorage" 
+QUEUE_NAME = "media-processing"
+PARTITION_KEY_FIELD = os.getenv('COSMOS_PARTITION_KEY_FIELD', 'id')
+ALBUM_PAGE_SIZE = int(os.getenv('ALBUM_PAGE_SIZE', '24'))
+SAS_SCOPE = os.getenv('SAS_SCOPE', 'blob')  # blob | container
+SAS_LIFETIME = timedelta(minutes=int(os.getenv('SAS_LIFETIME_MINUTES', '60')))
+SAS_REFRESH_MARGIN = timedelta(minutes=int(os.getenv('SAS_REFRESH_MINUTES', '20')))
+DIRECT_UPLOAD = os.getenv('DIRECT_UPLOAD', 'false').lower() == 'true'
+UPDATE_PATCH = os.getenv('UPDATE_PATCH', 'false').lower() == 'true'
+UPLOAD_BLOCK_SIZE = int(os.getenv('UPLOAD_BLOCK_SIZE_MB', '4')) * 1024 * 1024
+UPLOAD_CONCURRENCY = int(os.getenv('UPLOAD_CONCURRENCY', '4'))
+UPLOAD_SAS_LIFETIME = timedelta(minutes=15)
+ALBUM_AUTO_REFRESH_SECONDS = int(os.getenv('ALBUM_AUTO_REFRESH_SECONDS', '0'))
+TRANSLATION_LANGUAGES = os.getenv('TRANSLATION_LANGUAGES', 'English:en,French:fr,Japanese:ja')
+EAGER_TRANSLATION_LANGUAGES = [code.strip() for code in os.getenv('EAGER_TRANSLATION_LANGUAGES', '').split(',') if code.strip()]
+LIKE_COALESCE_SECONDS = float(os.getenv('LIKE_COALESCE_SECONDS', '0.5'))
+WRITE_RECONCILE_SECONDS = float(os.getenv('WRITE_RECONCILE_SECONDS', '1'))
+TRANSLATION_BULK_SIZE = int(os.getenv('TRANSLATION_BULK_SIZE', '100'))
+ALBUM_CACHE_TTL = int(os.getenv('ALBUM_CACHE_TTL_SECONDS', '60'))
+ALBUM_CACHE_MAX_BYTES = int(os.getenv('ALBUM_CACHE_MAX_MB', '64')) * 1024 * 1024
 FIREBASE_API_KEY = os.getenv('FIREBASE_API_KEY')
 
 
+def parse_languages(setting):
+    languages = {"Original": "Original"}
+    for entry in setting.split(','):
+        if ':' in entry:
+            name, code = entry.split(':', 1)
+            languages[name.strip()] = code.strip()
+
+    return languages
+
+LANGUAGES = parse_languages(TRANSLATION_LANGUAGES)
+
+
 def firebase_login(email, password):
     url = f"https://identitytoolkit.googleapis.com/v1/accounts:signInWithPassword?key={FIREBASE_API_KEY}"
     payload = {
@@ -89,20 +127,69 @@ def get_connection_settings(connection):
 
     return connection_settings_dict['AccountName'], connection_settings_dict['AccountKey']
 
-@st.cache_data(ttl=1800)
-def create_secure_temporary_link(file_name):        
+@st.cache_resource
+def get_link_signer():
     account_name, account_key = get_connection_settings(CONNECTION)
-    
-    sas_token = generate_blob_sas(
-        account_name=account_name,
-        container_name=CONTAINER,
-        blob_name=file_name,
-        account_key=account_key,
-        permission=BlobSasPermissions(read=True),
-        expiry = datetime.now(timezone.utc) + timedelta(minutes=30)
-    )
-    
-    return f"https://{account_name}.blob.core.windows.net/{CONTAINER}/{file_name}?{sas_token}"
+
+    return {
+        "account_name": account_name,
+        "account_key": account_key,
+        "links": {},
+        "lock": threading.Lock()
+    }
+
+def create_secure_temporary_links(file_names):
+    signer = get_link_signer()
+    account_name = signer['account_name']
+    base_url = f"https://{account_name}.blob.core.windows.net/{CONTAINER}"
+
+    now = datetime.now(timezone.utc)
+    expiry = now + SAS_LIFETIME
+    links = {}
+
+    with signer['lock']:
+        cache = signer['links']
+
+        # Tokens are re-signed well before they expire so a cached link is never served stale.
+        for name, (url, link_expiry) in list(cache.items()):
+            if link_expiry - now < SAS_REFRESH_MARGIN:
+                del cache[name]
+
+        if SAS_SCOPE == 'container':
+            if None not in cache:
+                sas_token = generate_container_sas(
+                    account_name=account_name,
+                    container_name=CONTAINER,
+                    account_key=signer['account_key'],
+                    permission=ContainerSasPermissions(read=True),
+                    expiry=expiry
+                )
+                cache[None] = (sas_token, expiry)
+
+            sas_token = cache[None][0]
+            return {name: f"{base_url}/{name}?{sas_token}" for name in file_names if name}
+
+        for name in file_names:
+            if not name:
+                continue
+
+            if name not in cache:
+                sas_token = generate_blob_sas(
+                    account_name=account_name,
+                    container_name=CONTAINER,
+                    blob_name=name,
+                    account_key=signer['account_key'],
+                    permission=BlobSasPermissions(read=True),
+                    expiry=expiry
+                )
+                cache[name] = (f"{base_url}/{name}?{sas_token}", expiry)
+
+            links[name] = cache[name][0]
+
+    return links
+
+def create_secure_temporary_link(file_name):
+    return create_secure_temporary_links([file_name]).get(file_name)
 
 def upload_media(create_url, file_object, user_file_name, user_name, user_id, is_private):
     file_extension = os.path.splitext(file_object.name)[1]
@@ -120,69 +207,277 @@ def upload_media(create_url, file_object, user_file_name, user_name, user_id, is
     
     return response.status_code
 
-@st.cache_data(ttl=60)
-def display_media(read_url, requesting_user_id):
-    separator = "&" if "?" in read_url else "?"        
-    secure_url = f"{read_url}{separator}userID={quote(requesting_user_id)}"
+def build_read_url(read_url, params):
+    separator = "&" if "?" in read_url else "?"
+    query = urlencode({key: value for key, value in params.items() if value is not None}, quote_via=quote)
+
+    return f"{read_url}{separator}{query}"
+
+@st.cache_resource
+def get_upload_queue():
+    # The worker expects base64 message bodies, matching what the CREATE function enqueues.
+    return QueueClient.from_connection_string(CONNECTION, QUEUE_NAME, message_encode_policy=TextBase64EncodePolicy())
+
+def upload_media_direct(file_object, user_file_name, user_name, user_id, is_private):
+    signer = get_link_signer()
+    account_name = signer['account_name']
+
+    document_id = str(uuid.uuid4())
+    file_extension = os.path.splitext(file_object.name)[1]
+    blob_name = f"{document_id}{file_extension}"
+
+    sas_token = generate_blob_sas(
+        account_name=account_name,
+        container_name=CONTAINER,
+        blob_name=blob_name,
+        account_key=signer['account_key'],
+        permission=BlobSasPermissions(create=True, write=True),
+        expiry=datetime.now(timezone.utc) + UPLOAD_SAS_LIFETIME
+    )
+    blob_url = f"https://{account_name}.blob.core.windows.net/{CONTAINER}/{blob_name}?{sas_token}"
+
+    try:
+        blob = BlobClient.from_blob_url(blob_url, max_block_size=UPLOAD_BLOCK_SIZE, max_single_put_size=UPLOAD_BLOCK_SIZE)
+
+        file_object.seek(0)
+        blob.upload_blob(
+            file_object,
+            length=file_object.size,
+            max_concurrency=UPLOAD_CONCURRENCY,
+            content_settings=ContentSettings(content_type=file_object.type)
+        )
+
+        message = {
+            "id": document_id,
+            "fileName": user_file_name,
+            "blobName": blob_name,
+            "userName": user_name,
+            "userID": user_id,
+            "isPrivate": str(is_private).lower()
+        }
+        get_upload_queue().send_message(json.dumps(message))
+        return 202
+    except Exception as e: return str(e)
+
+def display_media(read_url, requesting_user_id, page_size=None, continuation=None, visibility="visible"):
+    secure_url = build_read_url(read_url, {
+        "userID": requesting_user_id,
+        "visibility": visibility,
+        "pageSize": page_size,
+        "continuation": continuation
+    })
+    response = requests.get(secure_url)
+    data = response.json()
+
+    return response.status_code, data
+
+def is_visible(media_file, requesting_user_id):
+    return not media_file.get('isPrivate', False) or media_file.get('userID') == requesting_user_id
+
+def parse_media_page(data):
+    # Older READ deployments return the whole album as a plain list.
+    if isinstance(data, list):
+        return data, None
+
+    return data.get('items', []), data.get('continuation')
+
+@st.cache_resource
+def get_album_cache():
+    return {
+        "entries": OrderedDict(),
+        "size": 0,
+        "lock": threading.Lock()
+    }
+
+def cached_fetch(key, fetch):
+    cache = get_album_cache()
+
+    with cache['lock']:
+        entry = cache['entries'].get(key)
+        if entry and time.monotonic() - entry['fetched'] < ALBUM_CACHE_TTL:
+            cache['entries'].move_to_end(key)
+            return 200, entry['data']
+
+    status, data = fetch()
+    if status != 200:
+        return status, data
+
+    size = len(json.dumps(data))
+    with cache['lock']:
+        previous = cache['entries'].pop(key, None)
+        if previous:
+            cache['size'] -= previous['size']
+
+        cache['entries'][key] = {"data": data, "size": size, "fetched": time.monotonic()}
+        cache['size'] += size
+
+        while cache['size'] > ALBUM_CACHE_MAX_BYTES and len(cache['entries']) > 1:
+            evicted_key, evicted = cache['entries'].popitem(last=False)
+            cache['size'] -= evicted['size']
+
+    return status, data
+
+def invalidate_album_cache(owner_id=None):
+    cache = get_album_cache()
+
+    with cache['lock']:
+        for key in list(cache['entries']):
+            if key[0] == 'public' or key == ('private', owner_id):
+                cache['size'] -= cache['entries'].pop(key)['size']
+
+def load_album_page(read_url, requesting_user_id, continuation=None):
+    # Public items are shared by every session; each user only adds a small overlay of their private items.
+    status, data = cached_fetch(
+        ('public', ALBUM_PAGE_SIZE, continuation),
+        lambda: display_media(read_url, None, ALBUM_PAGE_SIZE, continuation, visibility="public")
+    )
+    if status != 200:
+        return status, [], None
+
+    items, next_continuation = parse_media_page(data)
+    items = list(items)
+
+    if continuation is None:
+        overlay_status, overlay = cached_fetch(
+            ('private', requesting_user_id),
+            lambda: display_media(read_url, requesting_user_id, visibility="private")
+        )
+        if overlay_status == 200:
+            private_items, _ = parse_media_page(overlay)
+            known_ids = {item.get('id') for item in items}
+
+            items = items + [item for item in private_items if item.get('id') not in known_ids]
+            items.sort(key=lambda item: item.get('_ts', 0), reverse=True)
+
+    return status, items, next_continuation
+
+def replace_album_item(document_id, changes):
+    # Album items may be shared with other sessions through the album cache, so never mutate them.
+    for index, item in enumerate(st.session_state.album_data):
+        if item.get('id') == document_id:
+            updated = dict(item)
+            updated.update(changes)
+            st.session_state.album_data[index] = updated
+            return updated
+
+    return None
+
+def fetch_media_changes(read_url, requesting_user_id, since):
+    # READ returns items with _ts > since. _ts only has one-second resolution, so the last
+    # second already seen is asked for again; a write later in that same second is not skipped.
+    secure_url = build_read_url(read_url, {
+        "userID": requesting_user_id,
+        "visibility": "visible",
+        "since": since - 1
+    })
     response = requests.get(secure_url)
     data = response.json()
 
     return response.status_code, data
 
+def latest_timestamp(items, since=None):
+    timestamps = [item['_ts'] for item in items if item.get('_ts') is not None]
+    if since is not None:
+        timestamps.append(since)
+
+    return max(timestamps) if timestamps else None
+
+def merge_media_changes(album_data, changed_items, deleted_ids):
+    positions = {item.get('id'): index for index, item in enumerate(album_data)}
+    new_items = []
+    changed = 0
+
+    # Items re-read from the overlapping second arrive unchanged and are left alone.
+    for item in changed_items:
+        index = positions.get(item.get('id'))
+        if index is None:
+            new_items.append(item)
+        elif album_data[index] != item:
+            album_data[index] = item
+            changed += 1
+
+    deleted = set(deleted_ids)
+    if deleted:
+        remaining = [item for item in album_data if item.get('id') not in deleted]
+        changed += len(album_data) - len(remaining)
+        album_data[:] = remaining
+
+    # Newest uploads go first, matching the order of the first page.
+    album_data[:0] = new_items
+
+    return changed + len(new_items)
+
 def format_url(url, item_id):
     safe_id = quote(str(item_id), safe='') 
     target_url = url.replace("%7Bid%7D", safe_id)
 
     return target_url
 
-def update_media_metadata(update_url, document_id, media_file, user_file_name, is_private):
+def apply_patch_operations(media_file, operations):
     data = media_file.copy()
 
-    data['fileName'] = user_file_name
-    data['isPrivate'] = is_private
+    for operation in operations:
+        field = operation['path'].strip('/').split('/')[0]
+        if operation['op'] == 'incr':
+            data[field] = data.get(field, 0) + operation['value']
+        elif operation['op'] == 'add':
+            data[field] = list(data.get(field, [])) + [operation['value']]
+        else:
+            data[field] = operation['value']
 
-    system_keys = [k for k in data.keys() if k.startswith('_')]
-    for k in system_keys:
-        data.pop(k)
-    
-    target_url = format_url(update_url, document_id)
-    try:
-        response = requests.put(target_url, json=data)
-        return response.status_code
-    except Exception as e: return str(e)
+    return data
 
-def update_media_likes(update_url, document_id, media_file, new_likes_count):
-    data = media_file.copy()
+def put_media(update_url, document_id, data):
+    data = data.copy()
 
-    data['likes'] = new_likes_count
+    # The copy dates from when the page rendered, so refuse to overwrite anything written since.
+    headers = {"If-Match": data['_etag']} if data.get('_etag') else {}
 
     system_keys = [k for k in data.keys() if k.startswith('_')]
     for k in system_keys:
         data.pop(k)
-    
+
     target_url = format_url(update_url, document_id)
     try:
-        response = requests.put(target_url, json=data)
+        response = requests.put(target_url, json=data, headers=headers)
         return response.status_code
     except Exception as e: return str(e)
 
-def update_media_comments(update_url, document_id, media_file, new_comment):
-    data = media_file.copy()
+def patch_media(update_url, document_id, media_file, operations):
+    if UPDATE_PATCH:
+        payload = {
+            "partitionKey": media_file.get(PARTITION_KEY_FIELD),
+            "operations": operations
+        }
 
-    current_comments = data.get('comments', [])
-    data['comments'] = list(current_comments) 
-    
-    data['comments'].append(new_comment)
+        target_url = format_url(update_url, document_id)
+        try:
+            response = requests.patch(target_url, json=payload)
+        except Exception as e: return str(e)
 
-    system_keys = [k for k in data.keys() if k.startswith('_')]
-    for k in system_keys:
-        data.pop(k)
-    
-    target_url = format_url(update_url, document_id)
-    try:
-        response = requests.put(target_url, json=data)
-        return response.status_code
-    except Exception as e: return str(e)
+        if response.status_code not in (404, 405):
+            return response.status_code
+
+    # UPDATE deployments without PATCH support only take the whole document.
+    return put_media(update_url, document_id, apply_patch_operations(media_file, operations))
+
+def update_media_metadata(update_url, document_id, media_file, user_file_name, is_private):
+    operations = [
+        {"op": "set", "path": "/fileName", "value": user_file_name},
+        {"op": "set", "path": "/isPrivate", "value": is_private}
+    ]
+
+    return patch_media(update_url, document_id, media_file, operations)
+
+def update_media_likes(update_url, document_id, media_file, increment=1):
+    operations = [{"op": "incr", "path": "/likes", "value": increment}]
+
+    return patch_media(update_url, document_id, media_file, operations)
+
+def update_media_comments(update_url, document_id, media_file, new_comment):
+    operations = [{"op": "add", "path": "/comments/-", "value": new_comment}]
+
+    return patch_media(update_url, document_id, media_file, operations)
 
 def delete_media(delete_url, item_id):
     target_url = format_url(delete_url, item_id)
@@ -199,15 +494,8 @@ def render_upload_section(current_user):
 
         st.divider()
 
-        languages = {
-            "Original": "Original",
-            "English": "en",
-            "French": "fr",
-            "Japanese": "ja"
-        }
-        
-        selected_language_name = st.selectbox("Language:", options=list(languages.keys()))
-        target_language_code = languages[selected_language_name]
+        selected_language_name = st.selectbox("Language:", options=list(LANGUAGES.keys()))
+        target_language_code = LANGUAGES[selected_language_name]
             
         st.divider()
 
@@ -224,7 +512,10 @@ def render_upload_section(current_user):
                         user_name = current_user['email']
                         user_id = current_user['id']
 
-                        status = upload_media(CREATE, uploaded_file, user_file_name, user_name, user_id, is_private)
+                        if DIRECT_UPLOAD:
+                            status = upload_media_direct(uploaded_file, user_file_name, user_name, user_id, is_private)
+                        else:
+                            status = upload_media(CREATE, uploaded_file, user_file_name, user_name, user_id, is_private)
                         if status == 202: st.success("Upload Started...")
                         else: st.error(f"Error: {status}")
         
@@ -235,6 +526,9 @@ def render_upload_section(current_user):
 def handle_delete(delete_url, document_id):
     response = delete_media(delete_url, document_id)
     if response == 200:
+        owners = [item.get('userID') for item in st.session_state.album_data if item.get('id') == document_id]
+        invalidate_album_cache(owners[0] if owners else None)
+
         st.session_state.album_data = [
             item for item in st.session_state.album_data 
             if item.get('id') != document_id
@@ -250,31 +544,144 @@ def handle_update_metadata(update_url, document_id, media_file, name_key, privac
     if new_user_file_name:
         response = update_media_metadata(update_url, document_id, media_file, new_user_file_name, new_privacy_status)
         if response == 200:
-            for item in st.session_state.album_data:
-                if item['id'] == document_id:
-                    item['fileName'] = new_user_file_name
-                    item['isPrivate'] = new_privacy_status
-                    break
+            replace_album_item(document_id, {'fileName': new_user_file_name, 'isPrivate': new_privacy_status})
+            invalidate_album_cache(media_file.get('userID'))
             
             st.session_state.edit_id = None
             st.toast("Updated!")
+        elif response == 412:
+            st.toast("This item changed since it was loaded. Refresh and try again.")
         else:
             st.toast(f"Failed: {response}")
 
-def handle_update_likes(update_url, document_id, media_file):
-    current_likes = media_file.get('likes', 0)
-    new_likes = current_likes + 1
+def get_write_queue():
+    if 'write_queue' not in st.session_state:
+        st.session_state.write_queue = {
+            "pending_likes": {},
+            "results": [],
+            "in_flight": 0,
+            "optimistic": {},
+            "lock": threading.Lock()
+        }
 
-    response = update_media_likes(update_url, document_id, media_file, new_likes)
-    
-    if response == 200:
-        for item in st.session_state.album_data:
-            if item['id'] == document_id:
-                item['likes'] = new_likes
+    return st.session_state.write_queue
+
+def record_write_result(write_queue, result):
+    with write_queue['lock']:
+        write_queue['results'].append(result)
+        write_queue['in_flight'] -= 1
+
+def writes_pending(write_queue):
+    with write_queue['lock']:
+        return write_queue['in_flight'] > 0 or bool(write_queue['results'])
+
+def apply_optimistic_change(write_queue, document_id, change):
+    # Consecutive optimistic changes to an item share a generation. Once a refresh or sync
+    # replaces the item, later writes start a new one and older failures are not rolled back.
+    for item in st.session_state.album_data or []:
+        if item.get('id') != document_id:
+            continue
+
+        updated = replace_album_item(document_id, change(item))
+        with write_queue['lock']:
+            entry = write_queue['optimistic'].get(document_id)
+            generation = 0 if entry is None else entry['generation'] + (entry['item'] is not item)
+            write_queue['optimistic'][document_id] = {"item": updated, "generation": generation}
+
+        return generation
+
+    return None
+
+def schedule_like_write(write_queue, update_url, document_id, media_file, generation=None):
+    # Clicks that land before the timer fires are folded into a single increment. The wait
+    # happens on the timer thread so shared pool workers never sit idle.
+    pool = get_background_pool()
+    timer = threading.Timer(LIKE_COALESCE_SECONDS, pool.submit, args=(run_like_write, write_queue, update_url, document_id, media_file, generation))
+    timer.daemon = True
+    timer.start()
+
+def run_like_write(write_queue, update_url, document_id, media_file, generation=None):
+    with write_queue['lock']:
+        increment = write_queue['pending_likes'].pop(document_id, 0)
+
+    status = update_media_likes(update_url, document_id, media_file, increment) if increment else 200
+    record_write_result(write_queue, {
+        "kind": "likes",
+        "doc_id": document_id,
+        "owner_id": media_file.get('userID'),
+        "increment": increment,
+        "generation": generation,
+        "status": status
+    })
+
+def run_comment_write(write_queue, update_url, document_id, media_file, new_comment, generation=None):
+    status = update_media_comments(update_url, document_id, media_file, new_comment)
+
+    if status == 200 and EAGER_TRANSLATION_LANGUAGES:
+        send_translation_request(
+            update_url,
+            document_id,
+            new_comment['timestamp'],
+            list(EAGER_TRANSLATION_LANGUAGES),
+            comment_id=new_comment['id'],
+            partition_key=media_file.get(PARTITION_KEY_FIELD)
+        )
+
+    record_write_result(write_queue, {
+        "kind": "comment",
+        "doc_id": document_id,
+        "owner_id": media_file.get('userID'),
+        "comment_id": new_comment['id'],
+        "generation": generation,
+        "status": status
+    })
+
+def reconcile_writes():
+    write_queue = get_write_queue()
+
+    with write_queue['lock']:
+        results = write_queue['results']
+        write_queue['results'] = []
+
+    for result in results:
+        if result['status'] == 200:
+            invalidate_album_cache(result['owner_id'])
+            continue
+
+        # Roll back the optimistic change that the failed write was carrying, unless the item
+        # has since been replaced by server data that never included it.
+        entry = write_queue['optimistic'].get(result['doc_id'])
+        for item in st.session_state.album_data or []:
+            if item.get('id') != result['doc_id']:
+                continue
+            if entry is None or entry['item'] is not item or entry['generation'] != result['generation']:
                 break
-        st.toast("Awarded!")
-    else:
-        st.toast(f"Failed: {response}")
+
+            if result['kind'] == 'likes':
+                entry['item'] = replace_album_item(result['doc_id'], {'likes': max(0, item.get('likes', 0) - result['increment'])})
+            else:
+                remaining = [comment for comment in item.get('comments', []) if comment.get('id') != result['comment_id']]
+                entry['item'] = replace_album_item(result['doc_id'], {'comments': remaining})
+            break
+
+        st.toast(f"Failed: {result['status']}")
+
+    return results
+
+def handle_update_likes(update_url, document_id, media_file):
+    write_queue = get_write_queue()
+    generation = apply_optimistic_change(write_queue, document_id, lambda item: {'likes': item.get('likes', 0) + 1})
+
+    with write_queue['lock']:
+        scheduled = document_id in write_queue['pending_likes']
+        write_queue['pending_likes'][document_id] = write_queue['pending_likes'].get(document_id, 0) + 1
+        if not scheduled:
+            write_queue['in_flight'] += 1
+
+    if not scheduled:
+        schedule_like_write(write_queue, update_url, document_id, media_file, generation)
+
+    st.toast("Awarded!")
 
 def handle_update_comments(update_url, document_id, media_file, input_key, current_user_email):
     comment_text = st.session_state.get(input_key)
@@ -290,29 +697,33 @@ def handle_update_comments(update_url, document_id, media_file, input_key, curre
             "translations": {}
         }
 
-        response = update_media_comments(update_url, document_id, media_file, new_comment)
-        
-        if response == 200:
-            for item in st.session_state.album_data:
-                if item['id'] == document_id:
-                    if 'comments' not in item:
-                        item['comments'] = []
-                    item['comments'].append(new_comment)
-                    break
-            
-            st.session_state[input_key] = "" 
-            st.toast("Posted!")
-        else:
-            st.toast(f"Failed: {response}")
+        write_queue = get_write_queue()
+        generation = apply_optimistic_change(write_queue, document_id, lambda item: {'comments': item.get('comments', []) + [new_comment]})
+
+        if EAGER_TRANSLATION_LANGUAGES:
+            mark_eager_translation_requested(document_id, comment_id)
+
+        with write_queue['lock']:
+            write_queue['in_flight'] += 1
+        get_background_pool().submit(run_comment_write, write_queue, update_url, document_id, media_file, new_comment, generation)
+
+        st.session_state[input_key] = "" 
+        st.toast("Posted!")
 
-def send_translation_request(update_url, doc_id, comment_timestamp, target_lang, comment_id=None):
+def send_translation_request(update_url, doc_id, comment_timestamp, target_lang, comment_id=None, partition_key=None):
     payload = {
         "task": "translate_comment",
         "docID": doc_id,
+        "partitionKey": partition_key,
         "commentTimestamp": comment_timestamp,
-        "commentID": comment_id,
-        "targetLang": target_lang
+        "commentID": comment_id
     }
+
+    if isinstance(target_lang, list):
+        payload["targetLangs"] = target_lang
+    else:
+        payload["targetLang"] = target_lang
+
     target_url = format_url(update_url, "translation_request")
     
     try:
@@ -321,6 +732,40 @@ def send_translation_request(update_url, doc_id, comment_timestamp, target_lang,
     except Exception:
         return False
 
+@st.cache_resource
+def get_background_pool():
+    return ThreadPoolExecutor(max_workers=4)
+
+def send_bulk_translation_request(update_url, target_lang, items):
+    payload = {
+        "task": "translate_comments",
+        "targetLang": target_lang,
+        "items": [
+            {
+                "docID": item['doc_id'],
+                "partitionKey": item.get('pk'),
+                "commentID": item.get('id'),
+                "commentTimestamp": item.get('ts')
+            }
+            for item in items
+        ]
+    }
+    target_url = format_url(update_url, "translation_request")
+
+    try:
+        requests.put(target_url, json=payload)
+        return True
+    except Exception:
+        return False
+
+def mark_eager_translation_requested(document_id, comment_id):
+    if 'requested_ids' not in st.session_state:
+        st.session_state.requested_ids = set()
+
+    # The eager job already covers these, so switching language will not ask again.
+    for language in EAGER_TRANSLATION_LANGUAGES:
+        st.session_state.requested_ids.add(f"{document_id}_{comment_id}_{language}")
+
 def handle_batch_translation(missing_items, update_url, target_lang):
     if 'requested_ids' not in st.session_state:
         st.session_state.requested_ids = set()
@@ -336,37 +781,150 @@ def handle_batch_translation(missing_items, update_url, target_lang):
 
     if not new_requests:
         return False
-        
-    for new_request in new_requests:
-        comment_id = new_request.get('id')
-        send_translation_request(update_url, new_request['doc_id'], new_request['ts'], target_lang, comment_id=comment_id)
+
+    # Each chunk becomes one queue message; sending happens off the script thread.
+    pool = get_background_pool()
+    for start in range(0, len(new_requests), TRANSLATION_BULK_SIZE):
+        chunk = new_requests[start:start + TRANSLATION_BULK_SIZE]
+        pool.submit(send_bulk_translation_request, update_url, target_lang, chunk)
     
     return True
 
-def render_album_tile(media_file, current_user, selected_lang_code):
+def build_comment_view(media_file, selected_lang_code):
+    missing = []
+    display = []
+
+    for comment in media_file.get('comments', []):
+        original_text = comment.get('text', '')
+        user_name = comment.get('user', 'anonymous')
+        saved_translations = comment.get('translations', {})
+
+        if selected_lang_code == "Original":
+            display_text = original_text
+        elif selected_lang_code in saved_translations:
+            display_text = saved_translations[selected_lang_code]
+        else:
+            display_text = original_text
+            missing.append({
+                'doc_id': media_file['id'],
+                'pk': media_file.get(PARTITION_KEY_FIELD),
+                'ts': comment.get('timestamp'),
+                'id': comment.get('id')
+            })
+
+        display.append((user_name, display_text, original_text))
+
+    return {"item": media_file, "missing": missing, "display": display}
+
+def take_missing_translations(comment_views):
+    # Requested comments stay untranslated until their item is replaced, so each view offers them once.
+    missing = []
+    for view in comment_views:
+        if view['missing']:
+            missing.extend(view['missing'])
+            view['missing'] = []
+
+    return missing
+
+def get_comment_view(comment_index, media_file, selected_lang_code):
+    # Album items are replaced, never mutated, on every change, so identity tells us when to rebuild.
+    views = comment_index.setdefault(media_file.get('id'), {})
+    view = views.get(selected_lang_code)
+
+    if view is None or view['item'] is not media_file:
+        view = build_comment_view(media_file, selected_lang_code)
+        views[selected_lang_code] = view
+
+    return view
+
+def handle_load_more(read_url, requesting_user_id):
+    continuation = st.session_state.get('album_continuation')
+    if not continuation:
+        return
+
+    status, items, next_continuation = load_album_page(read_url, requesting_user_id, continuation)
+    if status != 200:
+        st.toast(f"Failed: {status}")
+        return
+
+    known_ids = {item.get('id') for item in st.session_state.album_data}
+
+    st.session_state.album_data.extend(item for item in items if item.get('id') not in known_ids)
+    st.session_state.album_continuation = next_continuation
+    st.session_state.album_since = latest_timestamp(items, st.session_state.get('album_since'))
+
+def sync_album_data(read_url, requesting_user_id):
+    since = st.session_state.get('album_since')
+    if st.session_state.get('album_data') is None or since is None:
+        invalidate_album_cache(requesting_user_id)
+        st.session_state.album_data = None
+        return True
+
+    status, data = fetch_media_changes(read_url, requesting_user_id, since)
+    if status != 200:
+        st.toast(f"Failed: {status}")
+        return False
+
+    # READ deployments without delta support ignore 'since' and return the whole album.
+    if isinstance(data, list):
+        st.session_state.album_data = data
+        st.session_state.album_continuation = None
+        st.session_state.album_since = latest_timestamp(data)
+        return True
+
+    items = data.get('items', [])
+    changed = merge_media_changes(st.session_state.album_data, items, data.get('deleted', []))
+    st.session_state.album_since = latest_timestamp(items, since)
+
+    return changed > 0
+
+def render_album_tile(media_file, current_user, selected_lang_code, secure_url=None, thumbnail_url=None, comment_view=None):
     document_id = media_file.get('id')
 
     user_file_name = media_file.get('fileName', 'Unknown')
     stored_file_name = media_file.get('uniqueFileName', '')
+    thumbnail_file_name = media_file.get('thumbnailFileName')
 
     file_owner_name = media_file.get('userName', '')
     file_owner_id = media_file.get('userID', '')
 
     is_private = media_file.get('isPrivate', False)
     likes = media_file.get('likes', 0)
-    comments = media_file.get('comments', [])
+    if comment_view is None:
+        comment_view = build_comment_view(media_file, selected_lang_code)
+
+    if secure_url is None:
+        secure_url = create_secure_temporary_link(stored_file_name)
+
+    if thumbnail_url is None and thumbnail_file_name:
+        thumbnail_url = create_secure_temporary_link(thumbnail_file_name)
 
-    secure_url = create_secure_temporary_link(stored_file_name)
+    is_video = stored_file_name.lower().endswith(('.mp4', '.mov', '.avi', '.webm'))
+    show_original = not thumbnail_url or st.session_state.get('original_id') == document_id
     
     with st.container(border=True):
         with st.container(height=300, border=None, horizontal_alignment="center", vertical_alignment="center"):
-            if secure_url:
+            if not show_original:
+                st.image(thumbnail_url, width='content')
+
+            elif secure_url:
                 if stored_file_name.lower().endswith(('.png', '.jpg', '.jpeg')):
                     st.image(secure_url, width='content')
 
-                elif stored_file_name.lower().endswith(('.mp4', '.mov', '.avi', '.webm')):
+                elif is_video:
                     st.video(secure_url)
 
+        if not show_original:
+            def open_original():
+                st.session_state.original_id = document_id
+
+            st.button(
+                "Play" if is_video else "Full size",
+                key=f"original_{document_id}",
+                use_container_width=True,
+                on_click=open_original
+            )
+
         if file_owner_id == current_user['id']:
             is_editing = (st.session_state.edit_id == document_id)
 
@@ -441,19 +999,8 @@ def render_album_tile(media_file, current_user, selected_lang_code):
             )
 
         with st.container(height=200, border=False):
-            if comments:
-                for comment in comments:
-                    original_text = comment.get('text', '')
-                    user_name = comment.get('user', 'anonymous')
-                    saved_translations = comment.get('translations', {})
-
-                    if selected_lang_code == "Original":
-                        display_text = original_text
-                    elif selected_lang_code in saved_translations:
-                        display_text = saved_translations[selected_lang_code]
-                    else:
-                        display_text = original_text 
-
+            if comment_view['display']:
+                for user_name, display_text, original_text in comment_view['display']:
                     with st.chat_message("user"):
                         st.write(f"**{user_name}**: {display_text}")
                         
@@ -469,68 +1016,98 @@ def render_album_section(columns, current_user, target_language_code):
     if 'edit_id' not in st.session_state:
         st.session_state.edit_id = None
 
+    if 'original_id' not in st.session_state:
+        st.session_state.original_id = None
+
     if 'album_data' not in st.session_state:
         st.session_state.album_data = None
 
     if st.session_state.album_data is None:
         with st.spinner("Refreshing..."):
-            status, data = display_media(READ, current_user['id'])
+            status, items, continuation = load_album_page(READ, current_user['id'])
             if status == 200: 
-                st.session_state.album_data = data
+                st.session_state.album_data = items
+                st.session_state.album_continuation = continuation
+                st.session_state.album_since = latest_timestamp(items)
             else: 
                 st.error(f"Error: {status}")
-    
-    def refresh_data():
-        display_media.clear()
-        st.session_state.album_data = None
-        
+
+    if st.session_state.album_data is not None:
+        reconcile_writes()
+
+        if writes_pending(get_write_queue()):
+            # Polls while writes are in flight, so a failure is rolled back and reported on its own
+            # rather than on the next unrelated click. The full rerun also stops the polling.
+            @st.fragment(run_every=WRITE_RECONCILE_SECONDS)
+            def poll_writes():
+                results = reconcile_writes()
+                if any(result['status'] != 200 for result in results) or not writes_pending(get_write_queue()):
+                    st.rerun(scope="app")
+
+            poll_writes()
+
     if st.button("Refresh"):
-        refresh_data()
+        sync_album_data(READ, current_user['id'])
         st.rerun()
 
+    if ALBUM_AUTO_REFRESH_SECONDS > 0:
+        @st.fragment(run_every=ALBUM_AUTO_REFRESH_SECONDS)
+        def auto_refresh():
+            if sync_album_data(READ, current_user['id']):
+                st.rerun(scope="app")
+
+        auto_refresh()
+
     album_container = st.container()
 
     if st.session_state.album_data is not None:
         data = st.session_state.album_data
 
+        # READ already filters by visibility; this guard only matters for older deployments.
+        visible_files = [file for file in data if is_visible(file, current_user['id'])]
+
+        if 'comment_index' not in st.session_state:
+            st.session_state.comment_index = {}
+
+        comment_index = st.session_state.comment_index
+        comment_views = [get_comment_view(comment_index, file, target_language_code) for file in visible_files]
+
+        if len(comment_index) > len(visible_files):
+            visible_ids = {file.get('id') for file in visible_files}
+            for doc_id in [doc_id for doc_id in comment_index if doc_id not in visible_ids]:
+                del comment_index[doc_id]
+
         if target_language_code != "Original":
-            missing_translations = []
-            
-            for file in data:
-                is_private = file.get('isPrivate', False)
-                owner_id = file.get('userID')
-                if not is_private or (is_private and owner_id == current_user['id']):
-                    
-                    for comment in file.get('comments', []):
-                        if target_language_code not in comment.get('translations', {}):
-                            missing_translations.append({
-                                'doc_id': file['id'],
-                                'ts': comment['timestamp'],
-                                'id': comment.get('id')
-                            })
-            
+            missing_translations = take_missing_translations(comment_views)
+
             if missing_translations:
                 sent_new_work = handle_batch_translation(missing_translations, UPDATE, target_language_code)                
                 if sent_new_work:
                     st.toast(f"Translating...")
 
-        visible_files = []
-        for file in data:
-            owner_id = file.get('userID')
-            is_private = file.get('isPrivate', False)
-            
-            if not is_private or (is_private and owner_id == current_user['id']):
-                visible_files.append(file)
-        
         if not visible_files:
             st.info("No media found.")
-            return
+
+        secure_links = create_secure_temporary_links(
+            [file.get('uniqueFileName', '') for file in visible_files]
+            + [file.get('thumbnailFileName', '') for file in visible_files]
+        )
 
         with album_container:
             album_columns = st.columns(columns)
             for index, media_file in enumerate(visible_files):
                 with album_columns[index % columns]:
-                    render_album_tile(media_file, current_user, target_language_code)
+                    secure_url = secure_links.get(media_file.get('uniqueFileName', ''))
+                    thumbnail_url = secure_links.get(media_file.get('thumbnailFileName', ''))
+                    render_album_tile(media_file, current_user, target_language_code, secure_url, thumbnail_url, comment_views[index])
+
+        if st.session_state.get('album_continuation'):
+            st.button(
+                "Load more",
+                use_container_width=True,
+                on_click=handle_load_more,
+                args=(READ, current_user['id'])
+            )
 
 if __name__ == "__main__":
     st.set_page_config(page_title="Snippet", layout="wide")
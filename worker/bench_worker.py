@@ -0,0 +1,503 @@
+import os
+import io
+import re
+import sys
+import json
+import math
+import time
+import uuid
+import base64
+import random
+import argparse
+import threading
+from collections import Counter
+from contextlib import redirect_stdout
+from unittest.mock import patch
+from PIL import Image
+import requests
+from azure.core.exceptions import ServiceRequestError, ResourceNotFoundError
+from azure.cosmos.exceptions import CosmosHttpResponseError, CosmosResourceNotFoundError
+from azure.cosmos.exceptions import CosmosResourceExistsError, CosmosAccessConditionFailedError
+
+from bench_common import POINT_READ_RU, QUERY_BASE_RU, WRITE_RU, comment_text, add_report_arguments, report
+
+LANGUAGES = ("fr", "ja")
+GATED_METRICS = ("ru_per_message", "cosmos_operations", "translator_requests", "translator_characters")
+REPORT_COLUMNS = ('scenario', 'messages', 'poisoned', 'messages_per_second', 'job_p50_ms', 'job_p99_ms',
+                  'end_to_end_p99_ms', 'ru_per_message', 'cosmos_operations', 'translator_requests')
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+def document_units(doc):
+    return max(1, math.ceil(len(json.dumps(doc)) / 1024))
+
+
+class FakeService:
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.ops = Counter()
+        self.lock = threading.Lock()
+
+    def call(self, op):
+        with self.lock:
+            self.ops[op] += 1
+            failed = self.random.random() < self.error_rate
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        return failed
+
+
+class FakeMessage:
+    def __init__(self, content):
+        self.id = str(uuid.uuid4())
+        self.content = content
+        self.dequeue_count = 0
+        self.pop_receipt = None
+        self.inserted_at = time.monotonic()
+        self.received_at = None
+        self.visible_at = 0.0
+
+    def snapshot(self):
+        copy = FakeMessage(self.content)
+        copy.__dict__.update(self.__dict__)
+        return copy
+
+
+class FakeQueue(FakeService):
+    """Storage Queue stand-in with visibility timeouts, pop receipts and dequeue counts.
+
+    Visibility timeouts from receives are multiplied by visibility_scale and retry delays set
+    through update_message by time_scale, so redelivery paths finish within a benchmark run.
+    Errors are only injected on delete and update; the SDK retries receives on its own.
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, visibility_scale=0.1, time_scale=0.01, seed=0):
+        super().__init__(latency, error_rate, seed)
+        self.visibility_scale = visibility_scale
+        self.time_scale = time_scale
+        self.messages = {}
+        self.job_seconds = []
+        self.end_to_end_seconds = []
+
+    def send_message(self, content):
+        self.call('send')
+        msg = FakeMessage(content)
+
+        with self.lock:
+            self.messages[msg.id] = msg
+        return msg.snapshot()
+
+    def receive_messages(self, messages_per_page=None, max_messages=32, visibility_timeout=30):
+        self.call('receive')
+        now = time.monotonic()
+        received = []
+
+        with self.lock:
+            for msg in self.messages.values():
+                if len(received) >= max_messages: break
+                if msg.visible_at > now: continue
+
+                msg.dequeue_count += 1
+                msg.pop_receipt = str(uuid.uuid4())
+                msg.received_at = now
+                msg.visible_at = now + visibility_timeout * self.visibility_scale
+                received.append(msg.snapshot())
+
+        return received
+
+    def stored(self, msg, pop_receipt=None):
+        stored = self.messages.get(msg.id)
+        if stored is None or stored.pop_receipt != (pop_receipt or msg.pop_receipt):
+            raise ResourceNotFoundError("The specified message does not exist or the pop receipt does not match.")
+        return stored
+
+    def delete_message(self, msg, pop_receipt=None):
+        if self.call('delete'):
+            raise ServiceRequestError("Injected queue failure")
+
+        with self.lock:
+            stored = self.stored(msg, pop_receipt)
+            del self.messages[msg.id]
+
+            now = time.monotonic()
+            self.job_seconds.append(now - stored.received_at)
+            self.end_to_end_seconds.append(now - stored.inserted_at)
+
+    def update_message(self, msg, pop_receipt=None, content=None, visibility_timeout=None):
+        if self.call('update'):
+            raise ServiceRequestError("Injected queue failure")
+
+        with self.lock:
+            stored = self.stored(msg, pop_receipt)
+            stored.pop_receipt = str(uuid.uuid4())
+            if content is not None:
+                stored.content = content
+            if visibility_timeout is not None:
+                stored.visible_at = time.monotonic() + visibility_timeout * self.time_scale
+
+            return stored.snapshot()
+
+    def remaining(self):
+        with self.lock:
+            return len(self.messages)
+
+
+class FakeContainer(FakeService):
+    """Cosmos container stand-in covering the calls the worker makes, with RU-equivalent accounting."""
+
+    def __init__(self, documents=(), latency=0.0, error_rate=0.0, seed=0):
+        super().__init__(latency, error_rate, seed)
+        self.documents = {doc['id']: json.dumps(doc) for doc in documents}
+        self.request_units = 0.0
+
+    def charge(self, op, units):
+        if self.call(op):
+            raise CosmosHttpResponseError(status_code=503, message="Injected Cosmos failure")
+
+        with self.lock:
+            self.request_units += units
+
+    def read_item(self, item, partition_key, **kwargs):
+        body = self.documents.get(item)
+        self.charge('read', POINT_READ_RU * (document_units(json.loads(body)) if body else 1))
+
+        if body is None:
+            raise CosmosResourceNotFoundError(status_code=404, message="Entity with the specified id does not exist in the system.")
+        return json.loads(body)
+
+    def query_items(self, query, parameters=None, enable_cross_partition_query=False, **kwargs):
+        # Only the id lookup the worker falls back to is supported.
+        doc_id = parameters[0]['value']
+        body = self.documents.get(doc_id)
+        self.charge('query', QUERY_BASE_RU + (document_units(json.loads(body)) if body else 0))
+
+        return [json.loads(body)] if body else []
+
+    def write(self, op, body, must_not_exist=False):
+        self.charge(op, WRITE_RU * document_units(body))
+
+        with self.lock:
+            if must_not_exist and body['id'] in self.documents:
+                raise CosmosResourceExistsError(status_code=409, message="Entity with the specified id already exists in the system.")
+            self.documents[body['id']] = json.dumps(body)
+
+        return body
+
+    def upsert_item(self, body, **kwargs):
+        return self.write('upsert', body)
+
+    def create_item(self, body, **kwargs):
+        return self.write('create', body, must_not_exist=True)
+
+    def patch_item(self, item, partition_key, patch_operations, filter_predicate=None, **kwargs):
+        if self.call('patch'):
+            raise CosmosHttpResponseError(status_code=503, message="Injected Cosmos failure")
+
+        # Read, check and write under one lock, as the service applies a patch atomically.
+        with self.lock:
+            body = self.documents.get(item)
+            if body is None:
+                self.request_units += 1
+                raise CosmosResourceNotFoundError(status_code=404, message="Entity with the specified id does not exist in the system.")
+
+            doc = json.loads(body)
+            if filter_predicate and not predicate_matches(doc, filter_predicate):
+                self.request_units += 1
+                raise CosmosAccessConditionFailedError(status_code=412, message="Precondition failed.")
+
+            for operation in patch_operations:
+                apply_patch_operation(doc, operation)
+
+            self.documents[item] = json.dumps(doc)
+            self.request_units += WRITE_RU * document_units(doc)
+
+        return doc
+
+
+def predicate_matches(doc, predicate):
+    # Supports the comment-position conditions built by build_translation_patches.
+    comments = doc.get('comments', [])
+    for index, value in re.findall(r'c\.comments\[(\d+)\]\.id = ("(?:[^"\\]|\\.)*")', predicate):
+        index = int(index)
+        if index >= len(comments) or comments[index].get('id') != json.loads(value):
+            return False
+
+    return True
+
+def apply_patch_operation(doc, operation):
+    parts = [int(part) if part.isdigit() else part for part in operation['path'].strip('/').split('/')]
+    parent = doc
+    for part in parts[:-1]:
+        parent = parent[part]
+
+    key = parts[-1]
+    if operation['op'] == 'incr':
+        parent[key] = parent.get(key, 0) + operation['value']
+    elif operation['op'] == 'add' and isinstance(parent, list):
+        parent.insert(len(parent) if key == '-' else key, operation['value'])
+    else:
+        parent[key] = operation['value']
+
+
+class FakeTranslatorResponse:
+    def __init__(self, status_code, payload=None):
+        self.status_code = status_code
+        self.payload = payload
+        self.raw = None
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} Injected Translator failure")
+
+    def json(self):
+        return self.payload
+
+
+class FakeTranslatorSession(FakeService):
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0):
+        super().__init__(latency, error_rate, seed)
+        self.characters = 0
+
+    def post(self, url, params=None, headers=None, json=None, timeout=None):
+        if self.call('translate'):
+            return FakeTranslatorResponse(503)
+
+        with self.lock:
+            self.characters += sum(len(item['text']) for item in json) * len(params['to'])
+
+        return FakeTranslatorResponse(200, [
+            {'translations': [{'text': f"[{language}] {item['text']}", 'to': language} for language in params['to']]}
+            for item in json
+        ])
+
+
+class FakeBlob:
+    def __init__(self, data):
+        self.data = data
+
+    def readall(self):
+        return self.data
+
+    def readinto(self, stream):
+        stream.write(self.data)
+        return len(self.data)
+
+
+class FakeBlobContainer(FakeService):
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0):
+        super().__init__(latency, error_rate, seed)
+        self.blobs = {}
+
+    def get_blob_client(self, name):
+        container = self
+
+        class BlobClient:
+            def download_blob(self):
+                container.call('download')
+                return FakeBlob(container.blobs[name])
+
+        return BlobClient()
+
+    def upload_blob(self, name, data, overwrite=False, content_settings=None):
+        if self.call('upload'):
+            raise ServiceRequestError("Injected blob failure")
+        self.blobs[name] = data
+
+
+def encode_message(job_data):
+    # The webapp enqueues with TextBase64EncodePolicy.
+    return base64.b64encode(json.dumps(job_data).encode('utf-8')).decode('utf-8')
+
+def sample_image(rng, size=1024):
+    image = Image.new('RGB', (size, size), tuple(rng.randrange(256) for _ in range(3)))
+    output = io.BytesIO()
+    image.save(output, format='PNG')
+    return output.getvalue()
+
+def build_documents(rng, count, comments_per_document):
+    documents = []
+    for index in range(count):
+        comments = [
+            {'id': str(uuid.UUID(int=rng.getrandbits(128))), 'user': f"user{rng.randrange(50)}", 'text': comment_text(rng), 'timestamp': f"2025-01-01T00:{index % 60:02d}:{position:02d}"}
+            for position in range(comments_per_document)
+        ]
+        documents.append({
+            'id': f"doc{index}",
+            'fileName': f"photo{index}.png",
+            'uniqueFileName': f"blob{index}.png",
+            'userID': f"user{index % 50}",
+            'isPrivate': False,
+            'likes': 0,
+            'comments': comments
+        })
+
+    return documents
+
+def upload_scenario(rng, args, blobs):
+    messages = []
+    for index in range(args.messages):
+        blob_name = f"upload{index}.png"
+        blobs.blobs[blob_name] = sample_image(rng, args.image_size)
+        messages.append(encode_message({
+            'id': str(uuid.UUID(int=rng.getrandbits(128))),
+            'fileName': f"photo{index}.png",
+            'blobName': blob_name,
+            'userName': 'bench',
+            'userID': f"user{index % 50}",
+            'isPrivate': 'false'
+        }))
+
+    return [], messages
+
+def translation_scenario(rng, args, blobs):
+    documents = build_documents(rng, max(1, args.messages // (args.comments * len(LANGUAGES))), args.comments)
+
+    messages = []
+    for doc in documents:
+        for comment in doc['comments']:
+            for language in LANGUAGES:
+                messages.append(encode_message({
+                    'task': 'translate_comment',
+                    'docID': doc['id'],
+                    'partitionKey': doc['id'],
+                    'commentID': comment['id'],
+                    'commentTimestamp': comment['timestamp'],
+                    'targetLang': language
+                }))
+
+    # A few jobs point at comments that were deleted and should end up in the poison queue.
+    for doc in rng.sample(documents, min(len(documents), max(1, len(documents) // 20))):
+        messages.append(encode_message({'task': 'translate_comment', 'docID': doc['id'], 'commentID': 'deleted', 'targetLang': 'fr'}))
+
+    rng.shuffle(messages)
+    return documents, messages
+
+def bulk_translation_scenario(rng, args, blobs):
+    documents = build_documents(rng, max(1, args.messages // args.comments), args.comments)
+
+    messages = []
+    for language in LANGUAGES:
+        items = [
+            {'docID': doc['id'], 'partitionKey': doc['id'], 'commentID': comment['id'], 'commentTimestamp': comment['timestamp']}
+            for doc in documents for comment in doc['comments']
+        ]
+        for start in range(0, len(items), 100):
+            messages.append(encode_message({'task': 'translate_comments', 'targetLang': language, 'items': items[start:start + 100]}))
+
+    return documents, messages
+
+SCENARIOS = {
+    'upload': upload_scenario,
+    'translate': translation_scenario,
+    'translate_bulk': bulk_translation_scenario
+}
+
+def run_scenario(worker_module, name, args):
+    rng = random.Random(args.seed)
+    blobs = FakeBlobContainer(args.blob_latency_ms / 1000, seed=args.seed)
+    documents, contents = SCENARIOS[name](rng, args, blobs)
+
+    queue = FakeQueue(args.queue_latency_ms / 1000, args.queue_errors, args.visibility_scale, args.time_scale, args.seed)
+    poison = FakeQueue(seed=args.seed)
+    container = FakeContainer(documents, args.cosmos_latency_ms / 1000, args.cosmos_errors, args.seed)
+    translator = FakeTranslatorSession(args.translator_latency_ms / 1000, args.translator_errors, args.seed)
+
+    for content in contents:
+        queue.send_message(content)
+    queue.ops.clear()
+
+    worker_module.metrics.clear()
+    worker_module.histograms.clear()
+
+    stop = threading.Event()
+    deadline = time.monotonic() + args.timeout
+
+    def stop_when_drained():
+        while queue.remaining() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        stop.set()
+
+    with patch.object(worker_module, 'get_container', return_value=container), \
+         patch.object(worker_module, 'get_media_container', return_value=blobs), \
+         patch.object(worker_module, 'get_poison_queue', return_value=poison), \
+         patch.object(worker_module, 'start_instrumentation'), \
+         patch.object(worker_module, 'translator_session', translator), \
+         patch.object(worker_module, 'translation_cache', worker_module.TranslationCache(path=None)):
+
+        # Worker logging goes to stderr so the report on stdout stays machine readable.
+        started = time.monotonic()
+        threading.Thread(target=stop_when_drained, daemon=True).start()
+        with redirect_stdout(sys.stderr):
+            worker_module.worker(queue=queue, stop=stop)
+        seconds = time.monotonic() - started
+
+    settled = len(contents) - queue.remaining()
+    cosmos_operations = sum(container.ops.values())
+
+    return {
+        'scenario': name,
+        'messages': len(contents),
+        'settled': settled,
+        'poisoned': len(poison.messages),
+        'seconds': round(seconds, 3),
+        'messages_per_second': round(settled / seconds, 1) if seconds else 0.0,
+        'job_p50_ms': round(percentile(queue.job_seconds, 0.5) * 1000, 1),
+        'job_p99_ms': round(percentile(queue.job_seconds, 0.99) * 1000, 1),
+        'end_to_end_p50_ms': round(percentile(queue.end_to_end_seconds, 0.5) * 1000, 1),
+        'end_to_end_p99_ms': round(percentile(queue.end_to_end_seconds, 0.99) * 1000, 1),
+        'request_units': round(container.request_units, 1),
+        'ru_per_message': round(container.request_units / max(1, len(contents)), 2),
+        'cosmos_operations': cosmos_operations,
+        'cosmos': dict(container.ops),
+        'queue': dict(queue.ops),
+        'translator_requests': translator.ops['translate'],
+        'translator_characters': translator.characters,
+        'retried': worker_module.metrics.get('messages_retried', 0)
+    }
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Run worker() against in-process Queue, Cosmos and Translator stand-ins.")
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS), help="Scenario to run; repeatable. Defaults to all.")
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--comments', type=int, default=5, help="Comments per document in translation scenarios.")
+    parser.add_argument('--image-size', type=int, default=1024)
+    parser.add_argument('--concurrency', type=int, default=int(os.getenv('WORKER_CONCURRENCY', '4')))
+    parser.add_argument('--queue-latency-ms', type=float, default=5)
+    parser.add_argument('--cosmos-latency-ms', type=float, default=5)
+    parser.add_argument('--translator-latency-ms', type=float, default=50)
+    parser.add_argument('--blob-latency-ms', type=float, default=10)
+    parser.add_argument('--queue-errors', type=float, default=0.0, help="Failure rate for delete and update calls.")
+    parser.add_argument('--cosmos-errors', type=float, default=0.0)
+    parser.add_argument('--translator-errors', type=float, default=0.0)
+    parser.add_argument('--visibility-scale', type=float, default=0.1, help="Multiplier applied to receive visibility timeouts.")
+    parser.add_argument('--time-scale', type=float, default=0.01, help="Multiplier applied to retry delays.")
+    parser.add_argument('--timeout', type=float, default=300)
+    add_report_arguments(parser)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    # Settings are read at import time, so they are fixed before the worker is loaded.
+    os.environ['WORKER_CONCURRENCY'] = str(args.concurrency)
+    os.environ['METRICS_PORT'] = '0'
+    os.environ['METRICS_LOG_INTERVAL'] = '0'
+    os.environ.setdefault('POLL_MIN_DELAY', '0.01')
+    os.environ.setdefault('POLL_MAX_DELAY', '0.1')
+    import worker.worker as worker_module
+
+    results = [run_scenario(worker_module, name, args) for name in args.scenario or sorted(SCENARIOS)]
+    return report(results, args, 'scenario', REPORT_COLUMNS, lambda metric: metric in GATED_METRICS)
+
+if __name__ == "__main__":
+    sys.exit(main())
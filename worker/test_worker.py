@@ -1,10 +1,31 @@
 import unittest
 from unittest.mock import patch, MagicMock
-from worker.worker import call_azure_translator 
+import worker.worker as worker_module
+import base64
+import os
+import tempfile
+import json
+import threading
+from worker.worker import call_azure_translator, get_container, reset_container, handle_message, PollScheduler
+from worker.worker import chunk_translation_texts, process_translation_batch, TranslationCache, translate_texts, read_document
+from worker.worker import build_translation_patches, patch_translations
+from worker.worker import create_thumbnail, create_media_derivatives
+from worker.worker import split_messages, handle_translation_messages, retry_delay
+from worker.worker import MessageLeases, worker, process_upload
+from worker.worker import count, observe, render_metrics, start_metrics_server, toggle_profiler
+import urllib.request
+import urllib.error
+import time
+from PIL import Image
+import io
+from azure.cosmos.exceptions import CosmosResourceNotFoundError, CosmosAccessConditionFailedError, CosmosResourceExistsError
 
 class TestWorkerLogic(unittest.TestCase):
 
-    @patch('worker.worker.requests.post')
+    def setUp(self):
+        worker_module.translation_cache = TranslationCache(path=None)
+
+    @patch('worker.worker.translator_session.post')
     def test_call_azure_translator_success(self, mock_post):
         mock_response = MagicMock()
         mock_response.status_code = 200
@@ -16,14 +37,575 @@ class TestWorkerLogic(unittest.TestCase):
         result = call_azure_translator("Hello", "fr")
         self.assertEqual(result, "Bonjour")
         
-        args, _ = mock_post.call_args
+        args, kwargs = mock_post.call_args
         self.assertIn('/translate', args[0])
+        self.assertEqual(kwargs['timeout'], (worker_module.TRANSLATOR_CONNECT_TIMEOUT, worker_module.TRANSLATOR_READ_TIMEOUT))
 
-    @patch('worker.worker.requests.post')
+    @patch('worker.worker.translator_session.post')
     def test_call_azure_translator_failure(self, mock_post):
         mock_post.side_effect = Exception("Network Down")
         result = call_azure_translator("Hello", "fr")
         self.assertIsNone(result)
 
+    def test_translator_session_retries_throttling(self):
+        adapter = worker_module.translator_session.get_adapter(worker_module.TRANSLATOR_ENDPOINT)
+
+        self.assertIn(429, adapter.max_retries.status_forcelist)
+        self.assertTrue(adapter.max_retries.respect_retry_after_header)
+        self.assertIn('POST', adapter.max_retries.allowed_methods)
+
+    @patch('worker.worker.CosmosClient')
+    def test_get_container_reuses_client(self, mock_client):
+        reset_container()
+        worker_module.metrics.clear()
+
+        first = get_container()
+        second = get_container()
+
+        self.assertIs(first, second)
+        self.assertEqual(mock_client.call_count, 1)
+        self.assertEqual(worker_module.metrics['cosmos_client_created'], 1)
+
+        reset_container()
+        get_container()
+
+        self.assertEqual(mock_client.call_count, 2)
+        self.assertEqual(worker_module.metrics['cosmos_client_recreated'], 1)
+        reset_container()
+
+    @patch('worker.worker.process_upload')
+    def test_handle_message_deletes_on_success(self, mock_upload):
+        mock_upload.return_value = True
+        queue = MagicMock()
+        msg = MagicMock()
+        msg.content = base64.b64encode(json.dumps({'blobName': 'a.png'}).encode()).decode()
+
+        self.assertTrue(handle_message(queue, msg))
+        queue.delete_message.assert_called_once_with(msg)
+
+    @patch('worker.worker.process_comment_translation')
+    def test_handle_message_keeps_failed_message(self, mock_translation):
+        mock_translation.return_value = False
+        queue = MagicMock()
+        msg = MagicMock()
+        msg.dequeue_count = 2
+        msg.content = json.dumps({'task': 'translate_comment', 'docID': '1'})
+
+        self.assertFalse(handle_message(queue, msg))
+        queue.delete_message.assert_not_called()
+        queue.update_message.assert_called_once_with(msg, visibility_timeout=retry_delay(2))
+        self.assertGreater(retry_delay(2), retry_delay(1))
+
+    @patch('worker.worker.get_poison_queue')
+    @patch('worker.worker.get_container')
+    def test_handle_message_poisons_missing_comment(self, mock_get_container, mock_poison_queue):
+        container = MagicMock()
+        container.read_item.return_value = {'id': 'doc1', 'comments': []}
+        mock_get_container.return_value = container
+        queue = MagicMock()
+        msg = MagicMock()
+        msg.dequeue_count = 1
+        msg.content = json.dumps({'task': 'translate_comment', 'docID': 'doc1', 'commentID': 'gone', 'targetLang': 'fr'})
+
+        self.assertFalse(handle_message(queue, msg))
+        mock_poison_queue.return_value.send_message.assert_called_once_with(msg.content)
+        queue.delete_message.assert_called_once_with(msg)
+        queue.update_message.assert_not_called()
+
+    @patch('worker.worker.get_poison_queue')
+    @patch('worker.worker.process_upload')
+    def test_handle_message_poisons_after_max_dequeue(self, mock_upload, mock_poison_queue):
+        mock_upload.return_value = False
+        queue = MagicMock()
+        msg = MagicMock()
+        msg.dequeue_count = worker_module.MAX_DEQUEUE_COUNT
+        msg.content = json.dumps({'blobName': 'a.png'})
+
+        self.assertFalse(handle_message(queue, msg))
+        mock_poison_queue.return_value.send_message.assert_called_once_with(msg.content)
+        queue.delete_message.assert_called_once_with(msg)
+        queue.update_message.assert_not_called()
+
+    def test_poll_scheduler_backs_off_when_idle(self):
+        scheduler = PollScheduler(min_delay=1, max_delay=4)
+
+        delays = [scheduler.next_delay(0) for _ in range(4)]
+        self.assertEqual(delays, [1, 2, 4, 4])
+
+        self.assertEqual(scheduler.next_delay(5), 0)
+        self.assertEqual(scheduler.next_delay(0), 1)
+
+    def test_poll_scheduler_visibility_follows_job_time(self):
+        scheduler = PollScheduler(min_visibility=30, max_visibility=600)
+        self.assertEqual(scheduler.visibility_timeout(), 30)
+
+        scheduler.record_job(100)
+        self.assertEqual(scheduler.visibility_timeout(), 600)
+
+    def test_chunk_translation_texts_respects_limits(self):
+        texts = ['a' * 20000, 'b' * 20000, 'c' * 20000]
+
+        self.assertEqual(chunk_translation_texts(texts, ['fr']), [(0, 2), (2, 3)])
+        self.assertEqual(chunk_translation_texts(texts, ['fr', 'ja']), [(0, 1), (1, 2), (2, 3)])
+
+    @patch('worker.worker.call_azure_translator_batch')
+    @patch('worker.worker.get_container')
+    def test_process_translation_batch_groups_requests(self, mock_get_container, mock_translate):
+        container = MagicMock()
+        container.read_item.return_value = {
+            'id': 'doc1',
+            'comments': [{'id': 'c1', 'text': 'Hello'}, {'id': 'c2', 'text': 'Bye'}]
+        }
+        mock_get_container.return_value = container
+        mock_translate.return_value = [{'fr': 'Bonjour'}, {'fr': 'Au revoir'}]
+
+        jobs = [
+            {'docID': 'doc1', 'commentID': 'c1', 'targetLang': 'fr'},
+            {'docID': 'doc1', 'commentID': 'c2', 'targetLang': 'fr'}
+        ]
+
+        self.assertEqual(process_translation_batch(jobs), [True, True])
+        mock_translate.assert_called_once_with(['Hello', 'Bye'], ('fr',))
+        container.patch_item.assert_called_once()
+
+        kwargs = container.patch_item.call_args[1]
+        self.assertEqual(kwargs['item'], 'doc1')
+        self.assertIn({'op': 'set', 'path': '/comments/1/translations', 'value': {'fr': 'Au revoir'}}, kwargs['patch_operations'])
+        container.upsert_item.assert_not_called()
+
+    @patch('worker.worker.call_azure_translator_batch')
+    def test_translate_texts_uses_cache(self, mock_translate):
+        mock_translate.return_value = [{'fr': 'Super !'}]
+
+        first = translate_texts(['nice!', ' nice! '], ('fr',))
+        second = translate_texts(['nice!'], ('fr',))
+
+        self.assertEqual(first, [{'fr': 'Super !'}, {'fr': 'Super !'}])
+        self.assertEqual(second, [{'fr': 'Super !'}])
+        mock_translate.assert_called_once_with(['nice!'], ('fr',))
+
+    @patch('worker.worker.call_azure_translator_batch')
+    def test_translate_texts_sends_original_text(self, mock_translate):
+        mock_translate.return_value = [{'fr': 'Ligne un.\n\nLigne deux.'}]
+
+        translate_texts(['Line one.\n\nLine two.', 'Line one. Line two.'], ('fr',))
+
+        mock_translate.assert_called_once_with(['Line one.\n\nLine two.'], ('fr',))
+
+    @patch('worker.worker.call_azure_translator_batch')
+    def test_translate_texts_requests_only_missing_languages(self, mock_translate):
+        worker_module.translation_cache.put_many([('Hello', 'fr', 'Bonjour')])
+        mock_translate.side_effect = [[{'ja': 'こんにちは'}], [{'fr': 'Salut', 'ja': 'やあ'}]]
+
+        result = translate_texts(['Hello', 'Hi'], ('fr', 'ja'))
+
+        self.assertEqual(result, [{'fr': 'Bonjour', 'ja': 'こんにちは'}, {'fr': 'Salut', 'ja': 'やあ'}])
+        self.assertEqual(mock_translate.call_args_list[0][0], (['Hello'], ('ja',)))
+        self.assertEqual(mock_translate.call_args_list[1][0], (['Hi'], ('fr', 'ja')))
+
+    def test_translation_cache_persists_and_evicts(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cache.db')
+            cache = TranslationCache(path=path, max_entries=1)
+            cache.put_many([('hello', 'fr', 'bonjour'), ('bye', 'fr', 'au revoir')])
+
+            self.assertEqual(len(cache.entries), 1)
+
+            reopened = TranslationCache(path=path, max_entries=1)
+            self.assertEqual(reopened.get('hello', 'fr'), 'bonjour')
+            cache.db.close()
+            reopened.db.close()
+
+    def test_translation_cache_bounds_disk_table(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cache.db')
+            cache = TranslationCache(path=path, max_entries=10, max_disk_entries=2)
+            cache.put_many([('hello', 'fr', 'bonjour'), ('bye', 'fr', 'au revoir')])
+            cache.put_many([('thanks', 'fr', 'merci')])
+
+            self.assertEqual(cache.db.execute("SELECT COUNT(*) FROM translations").fetchone()[0], 2)
+
+            reopened = TranslationCache(path=path, max_entries=10)
+            self.assertIsNone(reopened.get('hello', 'fr'))
+            self.assertEqual(reopened.get('thanks', 'fr'), 'merci')
+            cache.db.close()
+            reopened.db.close()
+
+    def test_translation_cache_without_volume_stays_in_memory(self):
+        cache = TranslationCache(path='/nonexistent/translation_cache.db')
+        cache.put_many([('hello', 'fr', 'bonjour')])
+
+        self.assertIsNone(cache.db)
+        self.assertEqual(cache.get('hello', 'fr'), 'bonjour')
+
+    def test_read_document_prefers_point_read(self):
+        container = MagicMock()
+        container.read_item.return_value = {'id': 'doc1'}
+
+        self.assertEqual(read_document(container, 'doc1', 'user1'), {'id': 'doc1'})
+        container.read_item.assert_called_once_with(item='doc1', partition_key='user1')
+        container.query_items.assert_not_called()
+
+    def test_read_document_falls_back_to_query(self):
+        worker_module.metrics.clear()
+        container = MagicMock()
+        container.read_item.side_effect = CosmosResourceNotFoundError(message='missing')
+        container.query_items.return_value = [{'id': 'doc1'}]
+
+        self.assertEqual(read_document(container, 'doc1', 'wrong'), {'id': 'doc1'})
+        self.assertEqual(worker_module.metrics['cosmos_query_fallbacks'], 1)
+
+    @patch('worker.worker.PARTITION_KEY_FIELD', 'userID')
+    @patch('worker.worker.call_azure_translator_batch')
+    @patch('worker.worker.get_container')
+    def test_process_translation_batch_patches_with_document_partition_key(self, mock_get_container, mock_translate):
+        container = MagicMock()
+        container.read_item.side_effect = CosmosResourceNotFoundError(message='missing')
+        container.query_items.return_value = [{'id': 'doc1', 'userID': 'user1', 'comments': [{'id': 'c1', 'text': 'Hello'}]}]
+        mock_get_container.return_value = container
+        mock_translate.return_value = [{'fr': 'Bonjour'}]
+
+        jobs = [{'docID': 'doc1', 'commentID': 'c1', 'targetLang': 'fr', 'partitionKey': 'stale'}]
+
+        self.assertEqual(process_translation_batch(jobs), [True])
+        self.assertEqual(container.read_item.call_args[1]['partition_key'], 'stale')
+        self.assertEqual(container.patch_item.call_args[1]['partition_key'], 'user1')
+
+    def test_build_translation_patches_pins_comment_positions(self):
+        doc = {'id': 'doc1', 'comments': [
+            {'id': 'c1', 'text': 'Hi', 'translations': {'ja': 'やあ'}},
+            {'id': 'c2', 'text': 'Bye'}
+        ]}
+
+        patches = build_translation_patches(doc, {'c1': {'fr': 'Salut'}, 'c2': {'fr': 'Au revoir'}})
+
+        self.assertEqual(len(patches), 1)
+        operations, predicate = patches[0]
+        self.assertEqual(operations, [
+            {'op': 'set', 'path': '/comments/0/translations/fr', 'value': 'Salut'},
+            {'op': 'set', 'path': '/comments/1/translations', 'value': {'fr': 'Au revoir'}}
+        ])
+        self.assertEqual(predicate, 'FROM c WHERE c.comments[0].id = "c1" AND c.comments[1].id = "c2"')
+
+    def test_patch_translations_rereads_on_conflict(self):
+        container = MagicMock()
+        container.patch_item.side_effect = [CosmosAccessConditionFailedError(message='moved'), None]
+        container.read_item.return_value = {'id': 'doc1', 'comments': [{'id': 'c0'}, {'id': 'c1', 'translations': {}}]}
+        doc = {'id': 'doc1', 'comments': [{'id': 'c1', 'translations': {}}]}
+
+        self.assertTrue(patch_translations(container, doc, 'doc1', {'c1': {'fr': 'Salut'}}))
+
+        kwargs = container.patch_item.call_args[1]
+        self.assertEqual(kwargs['patch_operations'], [{'op': 'set', 'path': '/comments/1/translations/fr', 'value': 'Salut'}])
+
+    @patch('worker.worker.translate_texts')
+    @patch('worker.worker.get_container')
+    def test_process_translation_batch_isolates_malformed_jobs(self, mock_get_container, mock_translate):
+        container = MagicMock()
+        container.read_item.return_value = {'id': 'doc1', 'comments': [{'id': 'c1', 'text': 'Hello'}]}
+        mock_get_container.return_value = container
+        mock_translate.return_value = [{'fr': 'Bonjour'}]
+
+        jobs = [
+            {'task': 'translate_comment', 'docID': 'doc1', 'commentID': 'c1', 'targetLang': 'fr'},
+            {'task': 'translate_comment', 'commentID': 'c1', 'targetLang': 'fr'},
+            {'task': 'translate_comment', 'docID': 'doc1', 'commentID': 'c1'}
+        ]
+        permanent = set()
+
+        self.assertEqual(process_translation_batch(jobs, permanent), [True, False, False])
+        self.assertEqual(permanent, {1, 2})
+        container.patch_item.assert_called_once()
+
+    @patch('worker.worker.call_azure_translator_batch')
+    @patch('worker.worker.get_container')
+    def test_process_translation_batch_acknowledges_duplicates(self, mock_get_container, mock_translate):
+        container = MagicMock()
+        container.read_item.return_value = {
+            'id': 'doc1',
+            'comments': [
+                {'id': 'c1', 'text': 'Hello', 'translations': {'fr': 'Bonjour'}},
+                {'id': 'c2', 'text': 'Bye', 'translations': {}}
+            ]
+        }
+        mock_get_container.return_value = container
+        mock_translate.return_value = [{'ja': 'さようなら'}]
+
+        jobs = [
+            {'docID': 'doc1', 'commentID': 'c1', 'targetLang': 'fr'},
+            {'docID': 'doc1', 'commentID': 'c2', 'targetLang': 'ja'},
+            {'docID': 'doc1', 'commentID': 'c2', 'targetLang': 'ja'}
+        ]
+
+        self.assertEqual(process_translation_batch(jobs), [True, True, True])
+        container.read_item.assert_called_once()
+        container.patch_item.assert_called_once()
+        mock_translate.assert_called_once_with(['Bye'], ('ja',))
+
+    def test_create_thumbnail_shrinks_image(self):
+        source = io.BytesIO()
+        Image.new('RGB', (4000, 3000), 'red').save(source, format='JPEG')
+
+        thumbnail = Image.open(io.BytesIO(create_thumbnail(source.getvalue())))
+
+        self.assertEqual(thumbnail.format, worker_module.THUMBNAIL_FORMAT)
+        self.assertEqual(max(thumbnail.size), worker_module.THUMBNAIL_SIZE)
+
+    @patch('worker.worker.get_media_container')
+    def test_create_media_derivatives_for_image(self, mock_media_container):
+        source = io.BytesIO()
+        Image.new('RGB', (1200, 800), 'blue').save(source, format='PNG')
+        media = mock_media_container.return_value
+        media.get_blob_client.return_value.download_blob.return_value.readall.return_value = source.getvalue()
+
+        fields = create_media_derivatives('abc.png')
+
+        self.assertEqual(fields['thumbnailFileName'], 'thumbnails/abc.png.webp')
+        self.assertEqual(fields['thumbnailPath'], '/mediastorage/thumbnails/abc.png.webp')
+        media.upload_blob.assert_called_once()
+        self.assertEqual(create_media_derivatives('notes.txt'), {})
+
+    @patch('worker.worker.call_azure_translator_batch')
+    @patch('worker.worker.get_container')
+    def test_process_translation_batch_eager_languages(self, mock_get_container, mock_translate):
+        container = MagicMock()
+        container.read_item.return_value = {
+            'id': 'doc1',
+            'comments': [{'id': 'c1', 'text': 'Hello', 'translations': {'en': 'Hello'}}]
+        }
+        mock_get_container.return_value = container
+        mock_translate.return_value = [{'fr': 'Bonjour', 'ja': 'こんにちは'}]
+
+        jobs = [{'task': 'translate_comment', 'docID': 'doc1', 'commentID': 'c1', 'targetLangs': ['en', 'fr', 'ja']}]
+
+        self.assertEqual(process_translation_batch(jobs), [True])
+        mock_translate.assert_called_once_with(['Hello'], ('fr', 'ja'))
+
+    @patch('worker.worker.process_translation_batch')
+    def test_bulk_translation_message_acknowledged_when_all_jobs_succeed(self, mock_batch):
+        bulk = MagicMock()
+        bulk.content = json.dumps({
+            'task': 'translate_comments',
+            'targetLang': 'fr',
+            'items': [{'docID': 'doc1', 'commentID': 'c1'}, {'docID': 'doc2', 'commentID': 'c2'}]
+        })
+        single = MagicMock()
+        single.content = json.dumps({'task': 'translate_comment', 'docID': 'doc3', 'commentID': 'c3', 'targetLang': 'fr'})
+        upload = MagicMock()
+        upload.content = json.dumps({'blobName': 'a.png'})
+
+        translations, others = split_messages([bulk, single, upload])
+
+        self.assertEqual(others, [upload])
+        self.assertEqual([job['docID'] for msg, job in translations], ['doc1', 'doc2', 'doc3'])
+        self.assertEqual(translations[1][1]['targetLang'], 'fr')
+
+        queue = MagicMock()
+        bulk.dequeue_count = 1
+        mock_batch.return_value = [True, False, True]
+        handle_translation_messages(queue, translations)
+
+        queue.delete_message.assert_called_once_with(single)
+        queue.update_message.assert_called_once_with(bulk, visibility_timeout=retry_delay(1))
+
+    @patch('worker.worker.create_media_derivatives')
+    @patch('worker.worker.get_container')
+    def test_process_upload_is_idempotent(self, mock_get_container, mock_derivatives):
+        worker_module.recent_uploads.clear()
+        container = MagicMock()
+        container.read_item.return_value = {'id': 'u1', 'likes': 3}
+        mock_get_container.return_value = container
+        job = {'id': 'u1', 'fileName': 'a.png', 'blobName': 'b.png', 'userName': 'n', 'userID': 'x'}
+
+        self.assertTrue(process_upload(job))
+        self.assertTrue(process_upload(job))
+
+        container.read_item.assert_called_once()
+        container.create_item.assert_not_called()
+        container.upsert_item.assert_not_called()
+        mock_derivatives.assert_not_called()
+
+    @patch('worker.worker.create_media_derivatives')
+    @patch('worker.worker.get_container')
+    def test_process_upload_creates_when_absent(self, mock_get_container, mock_derivatives):
+        worker_module.recent_uploads.clear()
+        mock_derivatives.return_value = {'thumbnailFileName': 'thumbnails/b.png.webp'}
+        container = MagicMock()
+        container.read_item.side_effect = CosmosResourceNotFoundError(status_code=404, message="missing")
+        container.create_item.side_effect = CosmosResourceExistsError(status_code=409, message="exists")
+        mock_get_container.return_value = container
+        job = {'id': 'u2', 'fileName': 'a.png', 'blobName': 'b.png', 'userName': 'n', 'userID': 'x'}
+
+        # Losing a create race to another replica still counts as success.
+        self.assertTrue(process_upload(job))
+        self.assertEqual(container.create_item.call_args[0][0]['thumbnailFileName'], 'thumbnails/b.png.webp')
+
+    def test_message_leases_renew_until_settled(self):
+        queue = MagicMock()
+        queue.update_message.return_value = MagicMock(pop_receipt='r2')
+        msg = MagicMock(id='m1', pop_receipt='r1')
+
+        leases = MessageLeases(queue)
+        leases.add([msg], 30)
+        leases.renew_due(now=time.monotonic() + 10)
+        queue.update_message.assert_not_called()
+
+        leases.renew_due(now=time.monotonic() + 20)
+        queue.update_message.assert_called_once_with(msg, pop_receipt='r1', visibility_timeout=30)
+        self.assertEqual(msg.pop_receipt, 'r2')
+
+        leases.delete_message(msg)
+        queue.delete_message.assert_called_once_with(msg)
+        leases.renew_due(now=time.monotonic() + 60)
+        self.assertEqual(queue.update_message.call_count, 1)
+
+    @patch('worker.worker.SHUTDOWN_DEADLINE', 0.1)
+    @patch('worker.worker.start_instrumentation')
+    @patch('worker.worker.get_container')
+    @patch('worker.worker.process_upload')
+    def test_worker_leaves_running_jobs_leased_on_shutdown(self, mock_upload, mock_get_container, mock_instrumentation):
+        finish = threading.Event()
+        mock_upload.side_effect = lambda job_data: finish.wait(5)
+        msg = MagicMock(id='m1', pop_receipt='r1', dequeue_count=1)
+        msg.content = json.dumps({'blobName': 'a.png'})
+
+        batches = [[msg]]
+        queue = MagicMock()
+        queue.receive_messages.side_effect = lambda **kwargs: batches.pop() if batches else []
+
+        stop = threading.Event()
+        threading.Timer(0.2, stop.set).start()
+        self.assertEqual(worker(queue=queue, stop=stop), 1)
+        queue.update_message.assert_not_called()
+
+        # The overrunning job still settles with its own pop receipt.
+        finish.set()
+        for _ in range(100):
+            if queue.delete_message.called: break
+            time.sleep(0.01)
+        queue.delete_message.assert_called_once_with(msg)
+        self.assertEqual(msg.pop_receipt, 'r1')
+
+    @patch('worker.worker.start_instrumentation')
+    @patch('worker.worker.get_container')
+    @patch('worker.worker.process_upload', return_value=True)
+    def test_worker_survives_receive_failure(self, mock_upload, mock_get_container, mock_instrumentation):
+        worker_module.metrics.clear()
+        msg = MagicMock(id='m1', pop_receipt='r1', dequeue_count=1)
+        msg.content = json.dumps({'blobName': 'a.png'})
+
+        stop = threading.Event()
+        batches = [[msg], ConnectionError("Storage unavailable")]
+        def receive_messages(**kwargs):
+            batch = batches.pop() if batches else []
+            if isinstance(batch, Exception): raise batch
+            if not batches: stop.set()
+            return batch
+
+        queue = MagicMock()
+        queue.receive_messages.side_effect = receive_messages
+
+        with patch('worker.worker.PollScheduler', side_effect=lambda: PollScheduler(min_delay=0.01)):
+            self.assertEqual(worker(queue=queue, stop=stop), 0)
+
+        queue.delete_message.assert_called_once_with(msg)
+        self.assertEqual(worker_module.metrics['receive_failures'], 1)
+        self.assertEqual(worker_module.metrics['poll_backoff'], 1)
+
+    def test_message_leases_release_keeps_new_pop_receipt(self):
+        queue = MagicMock()
+        queue.update_message.return_value = MagicMock(pop_receipt='r2')
+        msg = MagicMock(id='m1', pop_receipt='r1')
+
+        leases = MessageLeases(queue)
+        leases.add([msg], 30)
+        leases.release_all()
+
+        queue.update_message.assert_called_once_with(msg, pop_receipt='r1', visibility_timeout=0)
+        self.assertEqual(msg.pop_receipt, 'r2')
+        self.assertEqual(leases.leases, {})
+
+    @patch('worker.worker.get_poison_queue')
+    def test_malformed_bulk_translation_message_is_poisoned(self, mock_poison_queue):
+        bulk = MagicMock()
+        bulk.dequeue_count = 1
+        bulk.content = json.dumps({'task': 'translate_comments', 'items': [{'docID': 'doc1'}, 'not-an-item']})
+
+        translations, others = split_messages([bulk])
+        self.assertEqual((translations, others), ([], [bulk]))
+
+        queue = MagicMock()
+        self.assertFalse(handle_message(queue, bulk))
+        mock_poison_queue.return_value.send_message.assert_called_once_with(bulk.content)
+        queue.delete_message.assert_called_once_with(bulk)
+
+    @patch('worker.worker.process_translation_batch')
+    def test_failed_translation_batch_settles_each_message(self, mock_batch):
+        healthy = MagicMock(dequeue_count=1)
+        broken = MagicMock(dequeue_count=1)
+        entries = [(healthy, {'docID': 'doc1'}), (broken, {'docID': 'doc2'})]
+
+        def batch(jobs, permanent):
+            if len(jobs) > 1:
+                raise RuntimeError("shared batch failed")
+            if jobs[0]['docID'] == 'doc2':
+                raise RuntimeError("bad message")
+            return [True]
+        mock_batch.side_effect = batch
+
+        queue = MagicMock()
+        self.assertFalse(handle_translation_messages(queue, entries))
+
+        queue.delete_message.assert_called_once_with(healthy)
+        queue.update_message.assert_called_once_with(broken, visibility_timeout=retry_delay(1))
+
+    def test_render_metrics_prometheus_text(self):
+        worker_module.metrics.clear()
+        worker_module.histograms.clear()
+
+        count('jobs_total', task='upload', result='success')
+        observe('stage_seconds', 0.2, stage='translator', task='translate_comment')
+
+        text = render_metrics()
+
+        self.assertIn('snippet_worker_jobs_total{result="success",task="upload"} 1', text)
+        self.assertIn('snippet_worker_stage_seconds_bucket{stage="translator",task="translate_comment",le="0.25"} 1', text)
+        self.assertIn('snippet_worker_stage_seconds_bucket{stage="translator",task="translate_comment",le="0.1"} 0', text)
+        self.assertIn('snippet_worker_stage_seconds_count{stage="translator",task="translate_comment"} 1', text)
+
+    def test_metrics_endpoint_and_profiler(self):
+        server = start_metrics_server(port=0)
+        try:
+            count('messages_received', 3)
+            url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+            body = urllib.request.urlopen(url).read().decode('utf-8')
+            self.assertIn('snippet_worker_messages_received', body)
+
+            profile_url = f"http://127.0.0.1:{server.server_address[1]}/profile"
+            with self.assertRaises(urllib.error.HTTPError) as context:
+                urllib.request.urlopen(profile_url)
+            self.assertEqual(context.exception.code, 405)
+            self.assertFalse(worker_module.profiler['running'])
+
+            started = json.loads(urllib.request.urlopen(urllib.request.Request(profile_url, method='POST')).read())
+            self.assertEqual(started['profiler'], 'started')
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        time.sleep(0.05)
+        report = toggle_profiler()
+        self.assertEqual(report['profiler'], 'stopped')
+        self.assertTrue(report['top'])
+
+    def test_profiler_toggles_are_serialized(self):
+        # Two overlapping starts must not leave two samplers or a stop with no thread to join.
+        threads = [threading.Thread(target=toggle_profiler) for _ in range(2)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+
+        self.assertFalse(worker_module.profiler['running'])
+        self.assertIsNone(worker_module.profiler['thread'])
+
 if __name__ == '__main__':
     unittest.main()
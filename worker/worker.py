@@ -4,28 +4,389 @@ import json
 import base64
 from dotenv import load_dotenv
 from azure.storage.queue import QueueClient
+from azure.storage.blob import BlobServiceClient, ContentSettings
 from azure.cosmos import CosmosClient
+from azure.cosmos.exceptions import CosmosResourceNotFoundError, CosmosAccessConditionFailedError, CosmosResourceExistsError
+from azure.core.exceptions import ServiceRequestError, ServiceResponseError, ResourceExistsError
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import uuid
+import math
+import threading
+import hashlib
+import sqlite3
+import unicodedata
+from collections import OrderedDict, Counter
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import signal
+import sys
+import io
+import subprocess
+import tempfile
+from PIL import Image, ImageOps
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 load_dotenv()
 
 STORAGE_CONNECTION = os.getenv('AZURE_CONNECTION_STRING')
 QUEUE_NAME = "media-processing"
+POISON_QUEUE_NAME = "media-processing-poison"
+MEDIA_CONTAINER = "mediastorage"
 COSMOS_URL = os.getenv('COSMOS_ENDPOINT') 
 COSMOS_KEY = os.getenv('COSMOS_KEY')
 DATABASE_NAME = "mediacollection"
 CONTAINER_NAME = "snippetmediacollection"
+PARTITION_KEY_FIELD = os.getenv('COSMOS_PARTITION_KEY_FIELD', 'id')
 TRANSLATOR_KEY = os.getenv('AZURE_TRANSLATOR_KEY')
 TRANSLATOR_REGION = os.getenv('AZURE_TRANSLATOR_REGION')
 TRANSLATOR_ENDPOINT = "https://api.cognitive.microsofttranslator.com"
+WORKER_CONCURRENCY = max(1, int(os.getenv('WORKER_CONCURRENCY', '1')))
+BATCH_SIZE = min(32, max(1, int(os.getenv('WORKER_BATCH_SIZE', '32'))))
+POLL_MIN_DELAY = float(os.getenv('POLL_MIN_DELAY', '0.5'))
+POLL_MAX_DELAY = float(os.getenv('POLL_MAX_DELAY', '30'))
+VISIBILITY_TIMEOUT_MIN = int(os.getenv('VISIBILITY_TIMEOUT_MIN', '30'))
+VISIBILITY_TIMEOUT_MAX = int(os.getenv('VISIBILITY_TIMEOUT_MAX', '600'))
+MAX_DEQUEUE_COUNT = int(os.getenv('MAX_DEQUEUE_COUNT', '5'))
+RETRY_BASE_DELAY = int(os.getenv('RETRY_BASE_DELAY', '30'))
+RETRY_MAX_DELAY = int(os.getenv('RETRY_MAX_DELAY', '3600'))
+SHUTDOWN_DEADLINE = float(os.getenv('SHUTDOWN_DEADLINE', '25'))
+LEASE_CHECK_INTERVAL = 1.0
+TRANSLATOR_MAX_TEXTS = 1000
+TRANSLATOR_MAX_CHARACTERS = 50000
+TRANSLATOR_POOL_SIZE = int(os.getenv('TRANSLATOR_POOL_SIZE', str(max(10, WORKER_CONCURRENCY))))
+TRANSLATOR_CONNECT_TIMEOUT = float(os.getenv('TRANSLATOR_CONNECT_TIMEOUT', '3.05'))
+TRANSLATOR_READ_TIMEOUT = float(os.getenv('TRANSLATOR_READ_TIMEOUT', '10'))
+TRANSLATOR_RETRIES = int(os.getenv('TRANSLATOR_RETRIES', '3'))
+THUMBNAIL_SIZE = int(os.getenv('THUMBNAIL_SIZE', '600'))
+THUMBNAIL_FORMAT = os.getenv('THUMBNAIL_FORMAT', 'WEBP').upper()
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+VIDEO_EXTENSIONS = ('.mp4', '.mov', '.avi', '.webm')
+TRANSLATION_WINDOW = float(os.getenv('TRANSLATION_WINDOW', '0.5'))
+PATCH_MAX_OPERATIONS = 10
+PATCH_ATTEMPTS = 3
+# Mount a volume here (an Azure Files share on the container app); without one the disk tier is
+# disabled, as a file inside the image would be lost on every restart or redeploy anyway.
+TRANSLATION_CACHE_PATH = os.getenv('TRANSLATION_CACHE_PATH', '/mnt/translation-cache/translation_cache.db')
+TRANSLATION_CACHE_SIZE = int(os.getenv('TRANSLATION_CACHE_SIZE', '10000'))
+TRANSLATION_CACHE_DISK_SIZE = int(os.getenv('TRANSLATION_CACHE_DISK_SIZE', '500000'))
+RECENT_UPLOADS_SIZE = int(os.getenv('RECENT_UPLOADS_SIZE', '10000'))
 
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_LOG_INTERVAL = float(os.getenv('METRICS_LOG_INTERVAL', '0'))
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', '0.01'))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+DEQUEUE_BUCKETS = (1, 2, 3, 5, 10)
+
+CONNECTION_ERRORS = (ServiceRequestError, ServiceResponseError)
+
+metrics = {}
+histograms = {}
+metrics_lock = threading.Lock()
+started_at = time.time()
+
+profiler = {"running": False, "samples": Counter(), "thread": None}
+profiler_lock = threading.Lock()
+
+cosmos_container = None
+cosmos_lock = threading.Lock()
+
+translation_cache = None
+translation_cache_lock = threading.Lock()
+
+media_container = None
+media_lock = threading.Lock()
+
+poison_queue = None
+poison_queue_lock = threading.Lock()
+
+recent_uploads = OrderedDict()
+recent_uploads_lock = threading.Lock()
+
+
+def metric_key(name, labels):
+    if not labels:
+        return name
+
+    return name + "{" + ",".join(f'{key}="{value}"' for key, value in sorted(labels.items())) + "}"
+
+def count(name, amount=1, **labels):
+    key = metric_key(name, labels)
+    with metrics_lock:
+        metrics[key] = metrics.get(key, 0) + amount
+
+def set_gauge(name, value, **labels):
+    key = metric_key(name, labels)
+    with metrics_lock:
+        metrics[key] = value
+
+def observe(name, value, buckets=LATENCY_BUCKETS, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = {"buckets": buckets, "counts": [0] * len(buckets), "sum": 0, "count": 0}
+            histograms[key] = histogram
+
+        for index, bound in enumerate(histogram['buckets']):
+            if value <= bound:
+                histogram['counts'][index] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+@contextmanager
+def timed(stage, task):
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        observe('stage_seconds', time.monotonic() - started, stage=stage, task=task)
+
+def render_metrics():
+    lines = []
+    with metrics_lock:
+        for key, value in sorted(metrics.items()):
+            lines.append(f"snippet_worker_{key} {value}")
+
+        for (name, labels), histogram in sorted(histograms.items()):
+            label_text = ",".join(f'{key}="{value}"' for key, value in labels)
+            prefix = f"snippet_worker_{name}"
+
+            for bound, bucket_count in zip(histogram['buckets'], histogram['counts']):
+                separator = "," if label_text else ""
+                lines.append(f'{prefix}_bucket{{{label_text}{separator}le="{bound}"}} {bucket_count}')
+            lines.append(f'{prefix}_bucket{{{label_text}{"," if label_text else ""}le="+Inf"}} {histogram["count"]}')
+            lines.append(f"{prefix}_sum{{{label_text}}} {histogram['sum']}")
+            lines.append(f"{prefix}_count{{{label_text}}} {histogram['count']}")
+
+    lines.append(f"snippet_worker_uptime_seconds {time.time() - started_at}")
+    return "\n".join(lines) + "\n"
+
+def metrics_snapshot():
+    with metrics_lock:
+        snapshot = dict(metrics)
+        for (name, labels), histogram in histograms.items():
+            key = metric_key(name, dict(labels))
+            snapshot[key] = {
+                "count": histogram['count'],
+                "mean": histogram['sum'] / histogram['count'] if histogram['count'] else 0
+            }
+
+    return snapshot
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/metrics':
+            self.respond(render_metrics().encode('utf-8'), 'text/plain; version=0.0.4')
+        elif self.path == '/profile':
+            # Switching the profiler changes state, so a crawler or prefetch must not do it.
+            self.send_response(405)
+            self.send_header('Allow', 'POST')
+            self.end_headers()
+        else:
+            self.send_response(404)
+            self.end_headers()
+
+    def do_POST(self):
+        if self.path == '/profile':
+            self.respond(json.dumps(toggle_profiler()).encode('utf-8'), 'application/json')
+        else:
+            self.send_response(404)
+            self.end_headers()
+
+    def respond(self, body, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(port=METRICS_PORT):
+    server = ThreadingHTTPServer(('0.0.0.0', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def log_metrics_forever(interval=METRICS_LOG_INTERVAL):
+    previous = 0
+    while True:
+        time.sleep(interval)
+        snapshot = metrics_snapshot()
+
+        processed = sum(value for key, value in snapshot.items() if key.startswith('jobs_total'))
+        snapshot['messages_per_second'] = (processed - previous) / interval
+        previous = processed
+
+        print(json.dumps({"metrics": snapshot}, default=str))
+
+def describe_frame(frame):
+    return f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}:{frame.f_lineno}"
+
+def sample_stacks():
+    own_thread = threading.get_ident()
+    while profiler['running']:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread:
+                continue
+
+            # Attribute library frames (ssl reads, json parsing) to the worker function waiting on them.
+            caller = frame
+            while caller is not None and os.path.basename(caller.f_code.co_filename) != 'worker.py':
+                caller = caller.f_back
+
+            sample = describe_frame(frame)
+            if caller is not None and caller is not frame:
+                sample = f"{describe_frame(caller)} > {sample}"
+            profiler['samples'][sample] += 1
+
+        time.sleep(PROFILE_INTERVAL)
+
+def toggle_profiler(*args):
+    # A low-overhead sampling profiler across every thread, switched with SIGUSR1 or POST /profile.
+    # Both can arrive at once, so the lock keeps a second sampler from starting.
+    with profiler_lock:
+        if not profiler['running']:
+            profiler['running'] = True
+            profiler['samples'] = Counter()
+            profiler['thread'] = threading.Thread(target=sample_stacks, daemon=True)
+            profiler['thread'].start()
+            print(json.dumps({"profiler": "started"}))
+            return {"profiler": "started"}
+
+        profiler['running'] = False
+        profiler['thread'].join()
+        profiler['thread'] = None
+        report = {"profiler": "stopped", "top": profiler['samples'].most_common(25)}
+        print(json.dumps(report))
+        return report
+
+def start_instrumentation():
+    if METRICS_PORT:
+        start_metrics_server()
+
+    if METRICS_LOG_INTERVAL > 0:
+        threading.Thread(target=log_metrics_forever, daemon=True).start()
+
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, toggle_profiler)
+
+def get_container():
+    global cosmos_container
+
+    with cosmos_lock:
+        if cosmos_container is None:
+            client = CosmosClient(COSMOS_URL, credential=COSMOS_KEY)
+            database = client.get_database_client(DATABASE_NAME)
+            cosmos_container = database.get_container_client(CONTAINER_NAME)
+
+            if metrics.get('cosmos_client_created'):
+                count('cosmos_client_recreated')
+            count('cosmos_client_created')
+
+        return cosmos_container
+
+def reset_container():
+    global cosmos_container
+
+    with cosmos_lock:
+        cosmos_container = None
+
+def get_media_container():
+    global media_container
+
+    with media_lock:
+        if media_container is None:
+            blob_service = BlobServiceClient.from_connection_string(STORAGE_CONNECTION)
+            media_container = blob_service.get_container_client(MEDIA_CONTAINER)
+
+        return media_container
+
+def create_thumbnail(image_bytes):
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+
+        if THUMBNAIL_FORMAT == 'JPEG' or image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGB')
+
+        output = io.BytesIO()
+        image.save(output, format=THUMBNAIL_FORMAT, quality=80)
+        return output.getvalue()
+
+def extract_poster_frame(video_path):
+    # Very short clips have no frame at 1s, so fall back to the first frame.
+    for offset in ('1', '0'):
+        result = subprocess.run(
+            ['ffmpeg', '-v', 'error', '-ss', offset, '-i', video_path, '-frames:v', '1', '-f', 'image2pipe', '-vcodec', 'png', '-'],
+            capture_output=True,
+            timeout=120
+        )
+        if result.returncode == 0 and result.stdout:
+            return result.stdout
+
+    return None
+
+def create_media_derivatives(blob_name):
+    extension = os.path.splitext(blob_name)[1].lower()
+    if extension not in IMAGE_EXTENSIONS + VIDEO_EXTENSIONS:
+        return {}
+
+    blob = get_media_container().get_blob_client(blob_name)
+
+    if extension in IMAGE_EXTENSIONS:
+        frame = blob.download_blob().readall()
+    else:
+        with tempfile.NamedTemporaryFile(suffix=extension) as video_file:
+            blob.download_blob().readinto(video_file)
+            video_file.flush()
+            frame = extract_poster_frame(video_file.name)
+
+    if not frame:
+        return {}
+
+    thumbnail_extension = '.jpg' if THUMBNAIL_FORMAT == 'JPEG' else f".{THUMBNAIL_FORMAT.lower()}"
+    thumbnail_name = f"thumbnails/{blob_name}{thumbnail_extension}"
+
+    get_media_container().upload_blob(
+        thumbnail_name,
+        create_thumbnail(frame),
+        overwrite=True,
+        content_settings=ContentSettings(content_type=f"image/{THUMBNAIL_FORMAT.lower()}")
+    )
+    count('thumbnails_created')
+
+    return {
+        "thumbnailFileName": thumbnail_name,
+        "thumbnailPath": f"/{MEDIA_CONTAINER}/{thumbnail_name}"
+    }
+
+def seen_upload(upload_id):
+    with recent_uploads_lock:
+        if upload_id in recent_uploads:
+            recent_uploads.move_to_end(upload_id)
+            return True
+
+    return False
+
+def remember_upload(upload_id):
+    with recent_uploads_lock:
+        recent_uploads[upload_id] = True
+        recent_uploads.move_to_end(upload_id)
+
+        while len(recent_uploads) > RECENT_UPLOADS_SIZE:
+            recent_uploads.popitem(last=False)
 
 def process_upload(job_data):
     try:
-        client = CosmosClient(COSMOS_URL, credential=COSMOS_KEY)
-        database = client.get_database_client(DATABASE_NAME)
-        container = database.get_container_client(CONTAINER_NAME)
+        # Redelivered uploads this replica already stored are acknowledged without touching Cosmos.
+        if seen_upload(job_data['id']):
+            count('uploads_duplicate', source='local')
+            return True
+
+        container = get_container()
 
         is_private = job_data.get('isPrivate', 'false')
         is_private_bool = str(is_private).lower() == 'true'
@@ -42,106 +403,924 @@ def process_upload(job_data):
             "comments": []
         }
 
-        container.upsert_item(new_document)
+        # A point read costs far less than the derivatives stage, so replays the local set
+        # missed (after a restart or on another replica) stop here.
+        with timed('cosmos_read', 'upload'):
+            try:
+                container.read_item(item=new_document['id'], partition_key=new_document.get(PARTITION_KEY_FIELD, new_document['id']))
+                count('uploads_duplicate', source='cosmos')
+                remember_upload(job_data['id'])
+                return True
+            except CosmosResourceNotFoundError: pass
+
+        # Derivatives are best-effort; the album falls back to the original when they are missing.
+        try:
+            with timed('derivatives', 'upload'):
+                new_document.update(create_media_derivatives(job_data['blobName']))
+        except Exception as e:
+            count('thumbnail_failures')
+            print(f"{e}")
+
+        # Create-if-absent: replaying an upload must not reset the likes and comments added since.
+        with timed('cosmos_write', 'upload'):
+            try:
+                container.create_item(new_document)
+            except CosmosResourceExistsError:
+                count('uploads_duplicate', source='cosmos')
+
+        remember_upload(job_data['id'])
         return True
 
-    except Exception as e: return False
+    except CONNECTION_ERRORS as e:
+        reset_container()
+        return False
+    except KeyError as e:
+        raise PermanentJobError(f"Upload message is missing {e}")
+    except Exception as e:
+        print(f"{e}")
+        return False
 
-def call_azure_translator(text, target_language):
+def create_translator_session():
+    # Retry-After is honoured for 429/503; other 5xx back off exponentially with jitter.
+    retry = Retry(
+        total=TRANSLATOR_RETRIES,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset(['POST']),
+        backoff_factor=0.5,
+        backoff_jitter=0.5,
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=TRANSLATOR_POOL_SIZE, max_retries=retry)
+
+    session = requests.Session()
+    session.mount('https://', adapter)
+    return session
+
+translator_session = create_translator_session()
+
+def call_azure_translator_batch(texts, target_languages):
     path = '/translate'
     url = TRANSLATOR_ENDPOINT + path
-    params = {'api-version': '3.0', 'to': target_language}
+    params = {'api-version': '3.0', 'to': list(target_languages)}
     headers = {
         'Ocp-Apim-Subscription-Key': TRANSLATOR_KEY,
         'Ocp-Apim-Subscription-Region': TRANSLATOR_REGION,
         'Content-type': 'application/json',
         'X-ClientTraceId': str(uuid.uuid4())
     }
-    body = [{'text': text}]
-    
-    try:
-        resp = requests.post(url, params=params, headers=headers, json=body)
-        return resp.json()[0]['translations'][0]['text']
-    except Exception as e: return None
+    body = [{'text': text} for text in texts]
 
-def process_comment_translation(job_data):
     try:
-        client = CosmosClient(COSMOS_URL, credential=COSMOS_KEY)
-        container = client.get_database_client(DATABASE_NAME).get_container_client(CONTAINER_NAME)
-        
-        doc_id = job_data['docID']
-        target_language = job_data['targetLang']
-        comment_timestamp = job_data['commentTimestamp']
-        comment_id = job_data.get('commentID')
+        with timed('translator', 'translate_comment'):
+            resp = translator_session.post(
+                url,
+                params=params,
+                headers=headers,
+                json=body,
+                timeout=(TRANSLATOR_CONNECT_TIMEOUT, TRANSLATOR_READ_TIMEOUT)
+            )
+        count('translator_requests')
+
+        retries = getattr(resp.raw, 'retries', None)
+        if retries is not None and retries.history:
+            count('translator_retries', len(retries.history))
+
+        resp.raise_for_status()
+
+        # Translations come back in the same order as the requested target languages.
+        results = []
+        for item in resp.json():
+            results.append({
+                language: translation['text']
+                for language, translation in zip(target_languages, item['translations'])
+            })
+        return results
+    except Exception as e:
+        count('translator_failures')
+        return None
+
+def call_azure_translator(text, target_language):
+    results = call_azure_translator_batch([text], [target_language])
+    if not results: return None
+
+    return results[0].get(target_language)
+
+def chunk_translation_texts(texts, target_languages):
+    chunks = []
+    start = 0
+    characters = 0
+
+    for index, text in enumerate(texts):
+        # The character limit counts each text once per target language.
+        size = len(text) * len(target_languages)
+        full = index - start >= TRANSLATOR_MAX_TEXTS or characters + size > TRANSLATOR_MAX_CHARACTERS
+
+        if index > start and full:
+            chunks.append((start, index))
+            start = index
+            characters = 0
+
+        characters += size
+
+    if start < len(texts):
+        chunks.append((start, len(texts)))
+
+    return chunks
+
+def normalize_text(text):
+    return ' '.join(unicodedata.normalize('NFC', text).split())
+
+class TranslationCache:
+    def __init__(self, path=TRANSLATION_CACHE_PATH, max_entries=TRANSLATION_CACHE_SIZE, max_disk_entries=TRANSLATION_CACHE_DISK_SIZE):
+        self.entries = OrderedDict()
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.lock = threading.Lock()
+        self.db = None
+
+        if path and not os.path.isdir(os.path.dirname(os.path.abspath(path))):
+            print(f"Translation cache directory for {path} is not mounted, caching in memory only")
+        elif path:
+            try:
+                self.db = sqlite3.connect(path, check_same_thread=False)
+                self.db.execute("CREATE TABLE IF NOT EXISTS translations (key TEXT PRIMARY KEY, text TEXT NOT NULL)")
+                self.db.commit()
+            except sqlite3.Error as e:
+                print(f"{e}")
+                self.db = None
+
+    def key(self, text, language):
+        digest = hashlib.sha256(normalize_text(text).encode('utf-8')).hexdigest()
+        return f"{language}:{digest}"
+
+    def remember(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            count('translation_cache_evictions')
 
+    def get(self, text, language):
+        key = self.key(text, language)
+
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                count('translation_cache_hits')
+                return self.entries[key]
+
+            if self.db:
+                try:
+                    row = self.db.execute("SELECT text FROM translations WHERE key = ?", (key,)).fetchone()
+                except sqlite3.Error as e: row = None
+
+                if row:
+                    self.remember(key, row[0])
+                    count('translation_cache_hits')
+                    count('translation_cache_disk_hits')
+                    return row[0]
+
+        count('translation_cache_misses')
+        return None
+
+    def put_many(self, items):
+        rows = [(self.key(text, language), translated_text) for text, language, translated_text in items]
+
+        with self.lock:
+            for key, translated_text in rows:
+                self.remember(key, translated_text)
+
+            if self.db:
+                try:
+                    self.db.executemany("INSERT OR REPLACE INTO translations (key, text) VALUES (?, ?)", rows)
+                    # A replaced row gets a new rowid, so the lowest rowids are the oldest writes.
+                    trimmed = self.db.execute(
+                        "DELETE FROM translations WHERE rowid <= (SELECT MAX(rowid) FROM translations) - ?",
+                        (self.max_disk_entries,)
+                    ).rowcount
+                    self.db.commit()
+                    if trimmed > 0:
+                        count('translation_cache_disk_evictions', trimmed)
+                except sqlite3.Error as e: print(f"{e}")
+
+def get_translation_cache():
+    global translation_cache
+
+    with translation_cache_lock:
+        if translation_cache is None:
+            translation_cache = TranslationCache()
+
+        return translation_cache
+
+def translate_texts(texts, target_languages):
+    cache = get_translation_cache()
+    translations = [{} for _ in texts]
+
+    # Identical texts are sent once, and only to the languages that are not cached yet.
+    # Normalization only decides what counts as identical; the original text is what gets translated.
+    pending = OrderedDict()
+    for index, text in enumerate(texts):
+        missing = []
+        for language in target_languages:
+            cached = cache.get(text, language)
+            if cached is not None:
+                translations[index][language] = cached
+            else:
+                missing.append(language)
+
+        if missing:
+            pending.setdefault(normalize_text(text), (text, tuple(missing), []))[2].append(index)
+
+    groups = OrderedDict()
+    for text, missing, indexes in pending.values():
+        groups.setdefault(missing, []).append((text, indexes))
+
+    for languages, entries in groups.items():
+        unique_texts = [text for text, indexes in entries]
+        for start, end in chunk_translation_texts(unique_texts, languages):
+            results = call_azure_translator_batch(unique_texts[start:end], languages)
+            if results is None: continue
+
+            cache.put_many([
+                (text, language, translated_text)
+                for text, result in zip(unique_texts[start:end], results)
+                for language, translated_text in result.items()
+                if translated_text
+            ])
+
+            for (text, indexes), result in zip(entries[start:end], results):
+                for index in indexes:
+                    translations[index].update(result)
+
+    return translations
+
+def read_document(container, doc_id, partition_key=None):
+    with timed('cosmos_read', 'translate_comment'):
+        if partition_key is None and PARTITION_KEY_FIELD == 'id':
+            partition_key = doc_id
+
+        if partition_key is not None:
+            try:
+                count('cosmos_point_reads')
+                return container.read_item(item=doc_id, partition_key=partition_key)
+            except CosmosResourceNotFoundError: pass
+
+        # Last resort for old messages without a partition key, or a key that no longer matches.
+        count('cosmos_query_fallbacks')
         query = "SELECT * FROM c WHERE c.id = @id"
         items = list(container.query_items(query=query, parameters=[{"name":"@id", "value": doc_id}], enable_cross_partition_query=True))
-        
-        if not items: return False
-        doc = items[0]
-        
-        updated = False
-        if 'comments' in doc:
-            for comment in doc['comments']:
-                match = False
-                
-                if comment_id and comment.get('id') == comment_id:
-                    match = True
-
-                if match:
-                    text_to_translate = comment.get('text')
-                    
-                    translated_text = call_azure_translator(text_to_translate, target_language)
-                    
-                    if translated_text:
-                        if 'translations' not in comment:
-                            comment['translations'] = {}
-                        
-                        comment['translations'][target_language] = translated_text
-                        updated = True
-                    break
-        
-        if updated:
-            container.upsert_item(doc)
-            return True
-            
+
+        if not items: return None
+        return items[0]
+
+def find_comment(doc, comment_id):
+    if not doc or not comment_id: return None
+
+    for comment in doc.get('comments', []):
+        if comment.get('id') == comment_id:
+            return comment
+
+    return None
+
+def build_translation_patches(doc, comment_updates):
+    patches = []
+    for index, comment in enumerate(doc.get('comments', [])):
+        new_translations = comment_updates.get(comment.get('id'))
+        if not new_translations: continue
+
+        path = f"/comments/{index}/translations"
+        if isinstance(comment.get('translations'), dict):
+            operations = [
+                {'op': 'set', 'path': f"{path}/{language}", 'value': translated_text}
+                for language, translated_text in new_translations.items()
+            ]
+        else:
+            operations = [{'op': 'set', 'path': path, 'value': dict(new_translations)}]
+
+        patches.append((index, comment['id'], operations))
+
+    # Cosmos accepts at most 10 operations per patch. Each request pins the comment
+    # positions it writes to, so a concurrent delete or reorder fails the precondition.
+    requests_to_send = []
+    operations = []
+    conditions = []
+    for index, comment_id, comment_operations in patches:
+        if operations and len(operations) + len(comment_operations) > PATCH_MAX_OPERATIONS:
+            requests_to_send.append((operations, "FROM c WHERE " + " AND ".join(conditions)))
+            operations = []
+            conditions = []
+
+        operations.extend(comment_operations)
+        conditions.append(f"c.comments[{index}].id = {json.dumps(comment_id)}")
+
+    if operations:
+        requests_to_send.append((operations, "FROM c WHERE " + " AND ".join(conditions)))
+
+    return requests_to_send
+
+def patch_translations(container, doc, partition_key, comment_updates):
+    with timed('cosmos_write', 'translate_comment'):
+        for attempt in range(PATCH_ATTEMPTS):
+            try:
+                for operations, predicate in build_translation_patches(doc, comment_updates):
+                    container.patch_item(
+                        item=doc['id'],
+                        partition_key=partition_key,
+                        patch_operations=operations,
+                        filter_predicate=predicate
+                    )
+                    count('cosmos_patches')
+                return True
+
+            except CosmosAccessConditionFailedError:
+                count('cosmos_patch_conflicts')
+                doc = read_document(container, doc['id'], partition_key)
+                if doc is None: return False
+
+        return False
+
+def job_languages(job_data):
+    # Eager translate-on-write jobs carry every configured language in one message.
+    if job_data.get('targetLangs'):
+        return list(job_data['targetLangs'])
+
+    return [job_data['targetLang']]
+
+def is_valid_translation_job(job_data):
+    if not isinstance(job_data, dict) or not isinstance(job_data.get('docID'), str) or not job_data['docID']:
         return False
 
+    languages = job_data.get('targetLangs') or [job_data.get('targetLang')]
+    return isinstance(languages, list) and all(isinstance(language, str) and language for language in languages)
+
+def process_translation_batch(jobs, permanent=None):
+    already_done = set()
+    translated = set()
+    written = set()
+    not_found = set()
+
+    # A malformed job fails on its own instead of taking the rest of the batch with it.
+    valid = [is_valid_translation_job(job_data) for job_data in jobs]
+    valid_jobs = [job_data for job_data, ok in zip(jobs, valid) if ok]
+
+    try:
+        container = get_container()
+
+        documents = {}
+        requested = {}
+        for job_data in valid_jobs:
+            doc_id = job_data['docID']
+            if doc_id not in documents:
+                # The message's key only locates the document; it may be stale if the read fell back to a query.
+                documents[doc_id] = read_document(container, doc_id, job_data.get('partitionKey'))
+
+            requested.setdefault((doc_id, job_data.get('commentID')), set()).update(job_languages(job_data))
+
+        requested_count = sum(len(job_languages(job_data)) for job_data in valid_jobs)
+        count('translation_jobs_coalesced', requested_count - sum(len(languages) for languages in requested.values()))
+
+        # Comments needing the same set of languages share Translator requests.
+        by_languages = {}
+        for (doc_id, comment_id), languages in requested.items():
+            comment = find_comment(documents[doc_id], comment_id)
+            if comment is None:
+                not_found.add((doc_id, comment_id))
+                continue
+
+            existing = comment.get('translations') or {}
+            for language in languages & existing.keys():
+                already_done.add((doc_id, comment_id, language))
+                count('translation_jobs_already_done')
+
+            missing = languages - existing.keys()
+            if missing:
+                by_languages.setdefault(tuple(sorted(missing)), []).append((doc_id, comment))
+
+        updates = {}
+        for languages, entries in by_languages.items():
+            texts = [comment.get('text', '') for doc_id, comment in entries]
+            results = translate_texts(texts, languages)
+
+            for (doc_id, comment), result in zip(entries, results):
+                for language, translated_text in result.items():
+                    if not translated_text: continue
+
+                    updates.setdefault(doc_id, {}).setdefault(comment['id'], {})[language] = translated_text
+                    translated.add((doc_id, comment['id'], language))
+
+        for doc_id, comment_updates in updates.items():
+            doc = documents[doc_id]
+
+            try:
+                if patch_translations(container, doc, doc.get(PARTITION_KEY_FIELD), comment_updates):
+                    written.add(doc_id)
+            except CONNECTION_ERRORS:
+                raise
+            except Exception as e: print(f"{e}")
+
+    except CONNECTION_ERRORS as e:
+        reset_container()
+    except Exception as e: print(f"{e}")
+
+    results = []
+    for index, job_data in enumerate(jobs):
+        if not valid[index]:
+            if permanent is not None:
+                permanent.add(index)
+            results.append(False)
+            continue
+
+        success = True
+        for language in job_languages(job_data):
+            key = (job_data['docID'], job_data.get('commentID'), language)
+            success = success and (key in already_done or (job_data['docID'] in written and key in translated))
+
+        # A deleted document or comment will never translate, however often it is retried.
+        if not success and permanent is not None and (job_data['docID'], job_data.get('commentID')) in not_found:
+            permanent.add(index)
+
+        results.append(success)
+
+    return results
+
+def process_comment_translation(job_data):
+    try:
+        permanent = set()
+        success = process_translation_batch([job_data], permanent)[0]
     except Exception as e: return False
 
-def worker():
-    queue = QueueClient.from_connection_string(STORAGE_CONNECTION, QUEUE_NAME)
+    if permanent:
+        raise PermanentJobError(f"Comment {job_data.get('commentID')} on {job_data.get('docID')} is missing or malformed")
+    return success
 
-    while True:
-        messages = queue.receive_messages(visibility_timeout=30)
+class PermanentJobError(Exception):
+    pass
+
+def get_poison_queue():
+    global poison_queue
+
+    if poison_queue is None:
+        with poison_queue_lock:
+            if poison_queue is None:
+                client = QueueClient.from_connection_string(STORAGE_CONNECTION, POISON_QUEUE_NAME)
+                try:
+                    client.create_queue()
+                except ResourceExistsError: pass
+                poison_queue = client
+
+    return poison_queue
+
+def poison_message(queue, msg, reason):
+    # The original content is kept so the message can be replayed once the cause is fixed.
+    get_poison_queue().send_message(msg.content)
+    queue.delete_message(msg)
+    count('messages_poisoned', reason=reason)
+    print(f"Moved message {msg.id} to {POISON_QUEUE_NAME}: {reason}")
+
+def retry_delay(dequeue_count):
+    return min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** max(0, dequeue_count - 1))
+
+def retry_message(queue, msg):
+    dequeue_count = msg.dequeue_count or 1
+    if dequeue_count >= MAX_DEQUEUE_COUNT:
+        poison_message(queue, msg, 'max_dequeue')
+        return
+
+    queue.update_message(msg, visibility_timeout=retry_delay(dequeue_count))
+    count('messages_retried')
+
+def is_exhausted(msg):
+    # Only messages that keep killing the worker mid-job get here without being settled.
+    return (msg.dequeue_count or 1) > MAX_DEQUEUE_COUNT
+
+def decode_message(msg):
+    with timed('decode', 'any'):
+        message_body = msg.content
+        try:
+            decoded_bytes = base64.b64decode(message_body)
+            json_str = decoded_bytes.decode('utf-8')
+        except:
+            json_str = message_body
+
+        job_data = json.loads(json_str)
+        if not isinstance(job_data, dict):
+            raise ValueError("Message is not a JSON object")
+        return job_data
+
+def task_name(job_data):
+    if job_data.get('task'):
+        return job_data['task']
+
+    return 'upload' if 'blobName' in job_data else 'unknown'
+
+def process_job(job_data):
+    if job_data.get('task') == 'translate_comment':
+        return process_comment_translation(job_data)
+
+    elif job_data.get('task') == 'translate_comments':
+        return all(process_translation_batch(expand_translation_job(job_data)))
+
+    elif 'blobName' in job_data:
+        return process_upload(job_data)
+
+    return True
+
+def expand_translation_job(job_data):
+    if job_data.get('task') != 'translate_comments':
+        return [job_data]
+
+    items = job_data.get('items', [])
+    if not isinstance(job_data.get('targetLang'), str) or not isinstance(items, list) \
+            or not all(isinstance(item, dict) for item in items):
+        raise PermanentJobError("Malformed bulk translation message")
+
+    # Bulk requests carry many comments for one target language.
+    return [
+        {
+            "task": "translate_comment",
+            "docID": item.get('docID'),
+            "partitionKey": item.get('partitionKey'),
+            "commentTimestamp": item.get('commentTimestamp'),
+            "commentID": item.get('commentID'),
+            "targetLang": job_data['targetLang']
+        }
+        for item in items
+    ]
+
+def split_messages(messages):
+    translations = []
+    others = []
+
+    for msg in messages:
+        try:
+            job_data = decode_message(msg)
+            if job_data.get('task') in ('translate_comment', 'translate_comments'):
+                translations.extend((msg, job) for job in expand_translation_job(job_data))
+                continue
+        except Exception as e:
+            # Undecodable and malformed messages go to handle_message, which moves them to the poison queue.
+            pass
+
+        others.append(msg)
+
+    return translations, others
+
+def settle_translation_messages(queue, entries, results, permanent):
+    # A bulk message is only acknowledged once every job it carried has succeeded,
+    # and only poisoned when none of its failures could succeed on a retry.
+    outcomes = OrderedDict()
+    for index, ((msg, job_data), success) in enumerate(zip(entries, results)):
+        msg, all_done, retryable = outcomes.get(id(msg), (msg, True, False))
+        outcomes[id(msg)] = (msg, all_done and success, retryable or (not success and index not in permanent))
+
+    for msg, all_done, retryable in outcomes.values():
+        try:
+            if all_done:
+                queue.delete_message(msg)
+            elif retryable:
+                retry_message(queue, msg)
+            else:
+                poison_message(queue, msg, 'not_found')
+        except Exception as e: print(f"{e}")
+
+def handle_translation_messages(queue, entries):
+    started = time.monotonic()
+    try:
+        permanent = set()
+        results = process_translation_batch([job_data for msg, job_data in entries], permanent)
+
+        observe('job_seconds', time.monotonic() - started, task='translate_comment')
+        for success in results:
+            count('jobs_total', task='translate_comment', result='success' if success else 'failure')
+
+        settle_translation_messages(queue, entries, results, permanent)
+        return all(results)
+
+    except Exception as e: print(f"{e}")
 
+    # The shared batch failed, so each message is retried on its own. Otherwise one bad
+    # message would keep every healthy one in lockstep until they are all poisoned.
+    by_message = OrderedDict()
+    for msg, job_data in entries:
+        by_message.setdefault(id(msg), []).append((msg, job_data))
+
+    for message_entries in by_message.values():
+        try:
+            permanent = set()
+            results = process_translation_batch([job_data for msg, job_data in message_entries], permanent)
+            settle_translation_messages(queue, message_entries, results, permanent)
+        except Exception as e:
+            print(f"{e}")
+            try:
+                retry_message(queue, message_entries[0][0])
+            except Exception as e: print(f"{e}")
+
+    count('translation_batch_fallbacks')
+    return False
+
+def handle_message(queue, msg):
+    started = time.monotonic()
+    task = 'unknown'
+    try:
+        try:
+            job_data = decode_message(msg)
+        except ValueError as e:
+            poison_message(queue, msg, 'malformed')
+            raise
+
+        task = task_name(job_data)
+
+        try:
+            success = process_job(job_data)
+        except PermanentJobError as e:
+            poison_message(queue, msg, 'permanent')
+            raise
+
+        if success:
+            queue.delete_message(msg)
+            count('jobs_total', task=task, result='success')
+            return True
+
+        retry_message(queue, msg)
+
+    except Exception as e: print(f"{e}")
+    finally:
+        observe('job_seconds', time.monotonic() - started, task=task)
+
+    count('jobs_total', task=task, result='failure')
+    return False
+
+class PollScheduler:
+    def __init__(self, min_delay=POLL_MIN_DELAY, max_delay=POLL_MAX_DELAY,
+                 min_visibility=VISIBILITY_TIMEOUT_MIN, max_visibility=VISIBILITY_TIMEOUT_MAX):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.min_visibility = min_visibility
+        self.max_visibility = max_visibility
+        self.delay = 0
+        self.job_seconds = None
+        self.lock = threading.Lock()
+
+    def next_delay(self, received):
+        if received:
+            self.delay = 0
+            count('poll_immediate')
+        else:
+            self.delay = min(self.max_delay, max(self.min_delay, self.delay * 2))
+            count('poll_backoff')
+
+        count('poll_received', received)
+        set_gauge('poll_delay_seconds', self.delay)
+        return self.delay
+
+    def record_job(self, seconds):
+        with self.lock:
+            if self.job_seconds is None:
+                self.job_seconds = seconds
+            else:
+                self.job_seconds = 0.8 * self.job_seconds + 0.2 * seconds
+
+    def visibility_timeout(self):
+        with self.lock:
+            job_seconds = self.job_seconds or 0
+
+        # Messages beyond the pool size wait their turn, so cover every wave of the batch.
+        waves = math.ceil(BATCH_SIZE / WORKER_CONCURRENCY)
+        timeout = math.ceil(job_seconds * waves * 2)
+        timeout = min(self.max_visibility, max(self.min_visibility, timeout))
+
+        set_gauge('visibility_timeout_seconds', timeout)
+        return timeout
+
+class MessageLeases:
+    """Keeps received messages invisible for as long as they are being worked on.
+
+    Handlers settle messages through this object instead of the queue, so a renewal
+    and a delete never race on the same pop receipt.
+    """
+
+    def __init__(self, queue, interval=LEASE_CHECK_INTERVAL):
+        self.queue = queue
+        self.interval = interval
+        self.leases = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def __getattr__(self, name):
+        return getattr(self.queue, name)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.renew_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def add(self, messages, visibility_timeout):
+        renew_at = time.monotonic() + visibility_timeout / 2
+
+        with self.lock:
+            for msg in messages:
+                self.leases[msg.id] = {
+                    "msg": msg,
+                    "timeout": visibility_timeout,
+                    "renew_at": renew_at,
+                    "lock": threading.Lock()
+                }
+            set_gauge('messages_leased', len(self.leases))
+
+    def pop(self, msg):
+        with self.lock:
+            lease = self.leases.pop(msg.id, None)
+            set_gauge('messages_leased', len(self.leases))
+
+        return lease
+
+    def forget(self, item):
+        # Whatever a handler left unsettled becomes visible again when its lease runs out.
+        messages = [entry[0] for entry in item] if isinstance(item, list) else [item]
         for msg in messages:
+            self.pop(msg)
+
+    def settle(self, msg, action):
+        lease = self.pop(msg)
+        if lease is None:
+            return action()
+
+        # Waits for a renewal in progress so the action uses the newest pop receipt.
+        with lease['lock']:
+            return action()
+
+    def delete_message(self, msg, *args, **kwargs):
+        return self.settle(msg, lambda: self.queue.delete_message(msg, *args, **kwargs))
+
+    def update_message(self, msg, *args, **kwargs):
+        return self.settle(msg, lambda: self.queue.update_message(msg, *args, **kwargs))
+
+    def renew_due(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            due = [lease for lease in self.leases.values() if lease['renew_at'] <= now]
+
+        for lease in due:
+            msg = lease['msg']
+            with lease['lock']:
+                if self.leases.get(msg.id) is not lease: continue
+
+                try:
+                    updated = self.queue.update_message(msg, pop_receipt=msg.pop_receipt, visibility_timeout=lease['timeout'])
+                    msg.pop_receipt = updated.pop_receipt
+                    lease['renew_at'] = time.monotonic() + lease['timeout'] / 2
+                    count('visibility_renewals')
+                except Exception as e:
+                    count('visibility_renewal_failures')
+                    print(f"{e}")
+
+    def renew_forever(self):
+        while not self.stopped.wait(self.interval):
+            self.renew_due()
+
+    def release_all(self):
+        with self.lock:
+            leases = list(self.leases.values())
+            self.leases.clear()
+            set_gauge('messages_leased', 0)
+
+        for lease in leases:
+            msg = lease['msg']
+            with lease['lock']:
+                try:
+                    updated = self.queue.update_message(msg, pop_receipt=msg.pop_receipt, visibility_timeout=0)
+                    msg.pop_receipt = updated.pop_receipt
+                    count('messages_released')
+                except Exception as e: print(f"{e}")
+
+def run_timed(scheduler, handler, queue, item):
+    started = time.monotonic()
+    try:
+        return handler(queue, item)
+    finally:
+        scheduler.record_job(time.monotonic() - started)
+        if isinstance(queue, MessageLeases):
+            queue.forget(item)
+
+def install_shutdown_handler(stop):
+    def request_shutdown(signum, frame):
+        print(f"Received signal {signum}, shutting down")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, request_shutdown)
+    signal.signal(signal.SIGINT, request_shutdown)
+
+def drain(pool, in_flight, leases, deadline):
+    started = time.monotonic()
+    done, unfinished = wait(in_flight, timeout=deadline)
+
+    # A job still running past the deadline keeps its message: renewals stop and the
+    # message reappears when its lease lapses, so no other replica runs it alongside.
+    running = []
+    for future in unfinished:
+        if not future.cancel():
+            leases.forget(in_flight[future])
+            running.append(future)
+
+    # Buffered and queued jobs never started, so their messages go straight back.
+    pool.shutdown(wait=False, cancel_futures=True)
+    leases.release_all()
+    leases.stop()
+
+    count('shutdown_unfinished_jobs', len(running))
+    print(f"Drained {len(done)} jobs in {time.monotonic() - started:.1f}s, {len(running)} still running")
+    return len(running)
+
+def worker(queue=None, stop=None):
+    # The queue and stop event can be injected so the loop can be driven in-process.
+    if queue is None:
+        queue = QueueClient.from_connection_string(STORAGE_CONNECTION, QUEUE_NAME)
+    if stop is None:
+        stop = threading.Event()
+        install_shutdown_handler(stop)
+
+    get_container()
+    start_instrumentation()
+
+    leases = MessageLeases(queue)
+    leases.start()
+
+    pool = ThreadPoolExecutor(max_workers=WORKER_CONCURRENCY)
+    scheduler = PollScheduler()
+    in_flight = {}
+    pending_translations = []
+    window_started = None
+
+    while not stop.is_set():
+        delay = None
+
+        if len(in_flight) < WORKER_CONCURRENCY:
+            visibility_timeout = scheduler.visibility_timeout()
             try:
-                message_body = msg.content
+                messages = list(queue.receive_messages(
+                    messages_per_page=BATCH_SIZE,
+                    max_messages=BATCH_SIZE,
+                    visibility_timeout=visibility_timeout
+                ))
+            except Exception as e:
+                # A failed poll counts as an empty one, so storage outages back off instead of ending the loop.
+                count('receive_failures')
+                print(f"{e}")
+                messages = []
+            leases.add(messages, visibility_timeout)
+
+            count('messages_received', len(messages))
+            for msg in messages:
+                observe('message_dequeue_count', msg.dequeue_count or 1, buckets=DEQUEUE_BUCKETS)
+                if (msg.dequeue_count or 1) > 1:
+                    count('messages_redelivered')
+
+            received = len(messages)
+            for msg in [msg for msg in messages if is_exhausted(msg)]:
+                messages.remove(msg)
                 try:
-                    decoded_bytes = base64.b64decode(message_body)
-                    json_str = decoded_bytes.decode('utf-8')
-                except:
-                    json_str = message_body
-                
-                job_data = json.loads(json_str)
-                success = False
-
-                if job_data.get('task') == 'translate_comment':
-                    success = process_comment_translation(job_data)
-
-                elif 'blobName' in job_data:
-                    success = process_upload(job_data)
-                
-                else:
-                    success = True
-
-                if success:
-                    queue.delete_message(msg)
-                
-            except Exception as e: print(f"{e}")
-        
-        time.sleep(2)
+                    poison_message(leases, msg, 'max_dequeue')
+                except Exception as e: print(f"{e}")
+                leases.forget(msg)
+
+            translations, others = split_messages(messages)
+
+            for msg in others:
+                in_flight[pool.submit(run_timed, scheduler, handle_message, leases, msg)] = msg
+
+            if translations and not pending_translations:
+                window_started = time.monotonic()
+            pending_translations.extend(translations)
+
+            delay = scheduler.next_delay(received)
+
+        # Translation jobs are held for a short window so sibling jobs on the same
+        # document share one read and one write. An empty poll closes the window early.
+        if pending_translations:
+            remaining = TRANSLATION_WINDOW - (time.monotonic() - window_started)
+
+            if delay or remaining <= 0:
+                in_flight[pool.submit(run_timed, scheduler, handle_translation_messages, leases, pending_translations)] = pending_translations
+                pending_translations = []
+            elif delay is None:
+                delay = remaining
+
+        # Never block for long, so a shutdown request is noticed while jobs are running.
+        if in_flight:
+            done, running = wait(in_flight, timeout=LEASE_CHECK_INTERVAL if delay is None else delay, return_when=FIRST_COMPLETED)
+            in_flight = {future: in_flight[future] for future in running}
+        elif delay:
+            stop.wait(delay)
+
+    return drain(pool, in_flight, leases, SHUTDOWN_DEADLINE)
 
 if __name__ == "__main__":
-    worker()
+    # Pool threads are joined at interpreter exit, which would outlive the deadline.
+    if worker():
+        sys.stdout.flush()
+        os._exit(1)